@@ -0,0 +1,4 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Benchmarks for the dymo hot paths, see benchmarks.run """
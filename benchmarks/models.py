@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from django.db import models
+
+
+class ModelDefinition(models.Model):
+    """ Stands in for the definition model of the benchmarked dynamic models.
+        Its permissions are propogated to the dynamic models.
+    """
+    name = models.CharField(max_length=127, unique=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+def build_model(name, field_count=0, db_table=None):
+    """ Builds a dynamic model class in this app, with the given number of 
+        CharFields.
+    """
+    attrs = {
+        '__module__': __name__,
+        '_hash': name,
+        '_definition_model': ModelDefinition,
+    }
+    for i in range(field_count):
+        attrs['field_%d' % i] = models.CharField(max_length=50, default="", blank=True)
+    if db_table:
+        attrs['Meta'] = type('Meta', (), {'db_table': db_table})
+    return type(str(name), (models.Model,), attrs)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Benchmarks for the dymo hot paths.
+
+    These run on an in-memory SQLite database with the locmem cache,
+    no other services are needed. Results are written as JSON, so that
+    they can be compared between releases.
+
+        python -m benchmarks.run --output results.json
+
+    Each result gives the best total time (in seconds) of the repeated runs,
+    the number of calls in a run and the time per call.
+"""
+
+import sys
+import time
+import platform
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.conf import settings
+
+# Above the largest number of models benchmarked, so that locmem doesn't 
+# cull model hashes (its default is 300 entries)
+MAX_CACHE_ENTRIES = 1000000
+
+if not settings.configured:
+    settings.configure(
+        DATABASES = {'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }},
+        CACHES = {'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': MAX_CACHE_ENTRIES},
+        }},
+        INSTALLED_APPS = (
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django.contrib.admin',
+            'south',
+            'dymo',
+            'benchmarks',
+        ),
+        ROOT_URLCONF = 'benchmarks.urls',
+    )
+
+import django
+from django.core.management import call_command
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.management import create_permissions
+from django.contrib.auth.models import User, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.db.models.signals import class_prepared
+
+from dymo import validation
+from dymo.db import update_table, add_necessary_db_columns
+from dymo.sync import get_cached_model, notify_model_change, remove_from_model_cache
+from dymo.admin import reregister_in_admin, propogate_permissions
+from dymo.registry import when_classes_prepared
+from dymo.metrics import MemoryMetrics, set_metrics_backend, get_metrics_backend
+
+from .models import ModelDefinition, build_model
+
+APP_LABEL = 'benchmarks'
+
+
+def bench(fn, calls=1, repeat=3, setup=None):
+    """ Times fn, returning the best of the repeated runs.
+        setup is called (untimed) before each run, its result is passed to fn.
+    """
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.time()
+        if setup is not None:
+            fn(arg)
+        else:
+            fn()
+        times.append(time.time() - start)
+    best = min(times)
+    return {'seconds': best, 'calls': calls, 'per_call': best / calls}
+
+
+def build_models(prefix, count, start=0):
+    models_ = [build_model('%s%d' % (prefix, i)) for i in range(start, start + count)]
+    for model in models_:
+        notify_model_change(model)
+    return models_
+
+
+def bench_get_cached_model(sizes, repeat):
+    results = {}
+    built = []
+    for size in sizes:
+        built.extend(build_models('Cached', size - len(built), len(built)))
+        names = [m._meta.object_name for m in built]
+        missing = ['Missing%d' % i for i in range(size)]
+
+        def hits():
+            for name in names:
+                get_cached_model(APP_LABEL, name)
+
+        def misses():
+            for name in missing:
+                get_cached_model(APP_LABEL, name)
+
+        counters = get_metrics_backend().counters
+        hit_count = counters.get('dymo.get_cached_model.hit', 0)
+        results['get_cached_model.hit.%d' % size] = bench(hits, size, repeat)
+        # Otherwise this would be timing regeneration
+        hit_count = counters.get('dymo.get_cached_model.hit', 0) - hit_count
+        if hit_count != size * repeat:
+            raise RuntimeError("Only %d of %d get_cached_model calls were cache hits" % (hit_count, size * repeat))
+        results['get_cached_model.miss.%d' % size] = bench(misses, size, repeat)
+    return results
+
+
+def bench_wide_tables(width, repeat):
+    results = {}
+    counter = [0]
+
+    def new_table_name():
+        counter[0] += 1
+        return 'bench_wide_%d' % counter[0]
+
+    def build(prefix, table_name, field_count):
+        model = build_model('%s%d' % (prefix, counter[0]), field_count, table_name)
+        # Keep these out of the app's model list, which later benchmarks scan
+        remove_from_model_cache(APP_LABEL, model._meta.object_name)
+        return model
+
+    # Create a wide table from nothing
+    results['update_table.create.%d' % width] = bench(update_table, 1, repeat,
+            setup=lambda: build('WideCreate', new_table_name(), width))
+
+    # Nothing to do, all columns exist
+    model = build('WideExisting', new_table_name(), width)
+    update_table(model)
+    results['add_necessary_db_columns.existing.%d' % width] = bench(
+            lambda: add_necessary_db_columns(model), 1, repeat)
+
+    # Half of the columns are missing
+    def half_missing():
+        table_name = new_table_name()
+        update_table(build('WideHalf', table_name, width // 2))
+        return build('WideFull', table_name, width)
+    results['add_necessary_db_columns.missing.%d' % (width - width // 2)] = bench(
+            add_necessary_db_columns, 1, repeat, setup=half_missing)
+
+    return results
+
+
+def bench_reregister_in_admin(sizes, repeat):
+    results = {}
+    for size in sizes:
+        admin_site = AdminSite(name='bench_%d' % size)
+        for model in build_models('Admin%d_' % size, size):
+            admin_site.register(model)
+        model = build_model('Admin%d_0' % size)
+        results['reregister_in_admin.%d' % size] = bench(
+            lambda: reregister_in_admin(admin_site, model), 1, repeat)
+    return results
+
+
+def bench_propogate_permissions(user_count, repeat):
+    parent_ct = ContentType.objects.get_for_model(ModelDefinition)
+    parent_permissions = list(Permission.objects.filter(content_type=parent_ct))
+    for i in range(user_count):
+        user = User.objects.create(username='bench_%d' % i)
+        user.user_permissions.add(*parent_permissions)
+
+    counter = [0]
+    def new_model():
+        counter[0] += 1
+        model = build_model('Permissions%d' % counter[0])
+        create_permissions(models.get_app(APP_LABEL), created_models=[], verbosity=0)
+        return model
+
+    return {'propogate_permissions.%d' % user_count:
+                bench(propogate_permissions, 1, repeat, setup=new_model)}
+
+
+def bench_startup(count, repeat):
+    counter = [0]
+    receivers = class_prepared.receivers[:]
+
+    def register():
+        counter[0] += 1
+        run = counter[0]
+        def build():
+            for i in range(count):
+                build_model('Startup%d_%d' % (run, i))
+        when_classes_prepared(APP_LABEL, ['StartupDependency%d' % run], build)
+        return run
+
+    def prepare_dependency(run):
+        build_model('StartupDependency%d' % run)
+
+    try:
+        return {'when_classes_prepared.%d' % count:
+                    bench(prepare_dependency, count, repeat, setup=register)}
+    finally:
+        # Don't leave the handlers running for every later model
+        class_prepared.receivers[:] = receivers
+
+
+def bench_validation(count, repeat):
+    slugs = [u'field-%d-name' % i for i in range(count)]
+
+    def validate():
+        for slug in slugs:
+            validation.validate_identifier_slug(slug)
+
+    def convert(fn):
+        def run():
+            for slug in slugs:
+                fn(slug)
+        return run
+
+    return {
+        'validate_identifier_slug.%d' % count: bench(validate, count, repeat),
+        'validate_identifier_slugs.%d' % count: bench(
+                lambda: validation.validate_identifier_slugs(slugs), count, repeat),
+        'slug_to_identifier.%d' % count: bench(
+                convert(validation.slug_to_identifier), count, repeat),
+        'slug_to_class_name.%d' % count: bench(
+                convert(validation.slug_to_class_name), count, repeat),
+        'slug_to_model_field_name.%d' % count: bench(
+                convert(validation.slug_to_model_field_name), count, repeat),
+    }
+
+
+def run(sizes=(10, 1000, 10000), repeat=3):
+    """ Runs all benchmarks, returning a dictionary of results. """
+    call_command('syncdb', interactive=False, verbosity=0)
+
+    metrics = MemoryMetrics()
+    set_metrics_backend(metrics)
+
+    results = {}
+    # Run these first, while the app has few models
+    results.update(bench_validation(max(sizes), repeat))
+    results.update(bench_wide_tables(200, repeat))
+    results.update(bench_propogate_permissions(1000, repeat))
+    results.update(bench_reregister_in_admin(sizes[:2], repeat))
+    results.update(bench_startup(100, repeat))
+    results.update(bench_get_cached_model(sizes, repeat))
+
+    set_metrics_backend(None)
+
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'repeat': repeat,
+        'results': results,
+        'counters': metrics.counters,
+    }
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m benchmarks.run [options]")
+    parser.add_option('--output', '-o', dest='output', default=None,
+        help='Write the JSON results to this file, instead of stdout.')
+    parser.add_option('--repeat', '-r', dest='repeat', type='int', default=3,
+        help='Number of runs per benchmark, the best is reported.')
+    parser.add_option('--sizes', '-s', dest='sizes', default='10,1000,10000',
+        help='Comma separated numbers of models for get_cached_model.')
+    options, args = parser.parse_args(argv)
+
+    sizes = tuple(int(s) for s in options.sizes.split(','))
+    output = json.dumps(run(sizes, options.repeat), indent=2, sort_keys=True)
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output)
+        finally:
+            f.close()
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
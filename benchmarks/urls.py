@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Reloaded by dymo.admin when models are (re-)registered
+from django.conf.urls.defaults import patterns
+
+urlpatterns = patterns('')
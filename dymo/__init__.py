@@ -2,10 +2,17 @@
 # -*- coding: UTF-8 -*-
 
 from .test import TestCase
-from .validation import validate_identifier_slug, slug_to_class_name, slug_to_identifier, slug_to_model_field_name
-from .db import update_table, create_db_table, delete_db_table, add_necessary_db_columns, rename_db_column, rename_db_table
-from .registry import when_classes_prepared, get_dynamic_models, register_dynamic_models
-from .sync import get_cached_model, remove_from_model_cache, notify_model_change, dynamic_model_changed, HASH_CACHE_TEMPLATE
-from .admin import unregister_from_admin, reregister_in_admin, propogate_permissions
-from .fields import IdentifierSlugField, ManyToManyField
-from .signals import connect_column_migration_signals, connect_table_migration_signals
+from .validation import validate_identifier_slug, validate_identifier_slugs, slug_to_class_name, slug_to_identifier, slugs_to_identifiers, slug_to_model_field_name
+from .validation import shorten_identifier, shorten_m2m_table_name, build_identifier_index
+from .db import update_table, create_db_table, delete_db_table, add_necessary_db_columns, rename_db_column, rename_db_columns, rename_db_table, rename_db_tables, sync_db_indexes
+from .registry import when_classes_prepared, get_dynamic_models, get_dynamic_model, register_dynamic_models, prewarm
+from .sync import get_cached_model, get_or_regenerate_model, remove_from_model_cache, notify_model_change, dynamic_model_changed, HASH_CACHE_TEMPLATE
+from .admin import unregister_from_admin, reregister_in_admin, propogate_permissions, create_dynamic_permissions, admin_urls
+from .fields import IdentifierSlugField, ManyToManyField, clear_m2m_attr_cache
+from .signals import connect_column_migration_signals, connect_table_migration_signals, batch_schema_changes, bulk_delete
+from .metrics import get_metrics_backend, set_metrics_backend, NullMetrics, MemoryMetrics
+from .warmstart import save_warm_start, load_warm_start, warm_start
+from .load import load_rows, read_csv, read_json_lines, RejectWriter
+from .export import iter_rows, export_csv, export_json_lines, export_to_file, export_models
+from .jobs import get_job_status, get_pending_jobs, run_pending_jobs, retry_failed_jobs
+from .routing import get_database, get_database_for_model, set_placement, HashPlacement, MappingPlacement, ChainedPlacement, DynamicModelRouter
@@ -2,20 +2,35 @@
 # -*- coding: UTF-8 -*-
 
 import logging
-from django.db import models
-from django.core.urlresolvers import clear_url_caches
+from django.db import transaction
+from django.db.models import Q
+from django.core.urlresolvers import clear_url_caches, RegexURLResolver
 from django.utils.importlib import import_module
 from django.conf import settings
 from django.contrib.admin.sites import NotRegistered
-from django.contrib.auth.management import create_permissions
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+
+from . import metrics
+from .db import bulk_save
 
 logger = logging.getLogger('dymo')
 
+# Dynamic models are routed in the admin with admin_urls(), instead of 
+# reloading the URL conf each time a model is (re-)registered
+ADMIN_URL_DISPATCH = getattr(settings, "DYMO_ADMIN_URL_DISPATCH", False)
+
+# The current ModelAdmin of each dynamic model registered with 
+# reregister_in_admin, keyed on (admin site name, app_label, module_name)
+_admin_registrations = {}
 
-def unregister_from_admin(admin_site, model=None, old_table_name=None, app_label=None, object_name=None):
-    " Removes the dynamic model from the given admin site "
+
+def unregister_from_admin(admin_site, model=None, old_table_name=None, app_label=None, object_name=None, reload_urls=None):
+    """ Removes the dynamic model from the given admin site.
+        reload_urls can be disabled when the URL conf will be reloaded later,
+        it is disabled by default with DYMO_ADMIN_URL_DISPATCH.
+    """
 
     if old_table_name is None and model is not None:
         old_table_name = model._meta.db_table
@@ -31,12 +46,15 @@ def unregister_from_admin(admin_site, model=None, old_table_name=None, app_label
         for reg_model in admin_site._registry.keys():
             if old_table_name == reg_model._meta.db_table:
                 del admin_site._registry[reg_model]
+                _forget_registration(admin_site, reg_model)
 
     # Try looking for same app_label/object_name
     if app_label and object_name:
         for reg_model in admin_site._registry.keys():
             if app_label == reg_model._meta.app_label and object_name == reg_model._meta.object_name:
                 del admin_site._registry[reg_model]
+                _forget_registration(admin_site, reg_model)
+        _admin_registrations.pop((admin_site.name, app_label, object_name.lower()), None)
 
     # Try the normal approach too
     if model is not None:
@@ -45,34 +63,182 @@ def unregister_from_admin(admin_site, model=None, old_table_name=None, app_label
         except NotRegistered:
             pass
 
-    # Reload the URL conf and clear the URL cache
-    # It's important to use the same string as ROOT_URLCONF
-    reload(import_module(settings.ROOT_URLCONF))
-    clear_url_caches()
+    if reload_urls is None:
+        reload_urls = not ADMIN_URL_DISPATCH
+    if reload_urls:
+        reload_urlconf()
 
     # logger.debug("Removed %r model from admin" % model.__name__)
 
 
-def reregister_in_admin(admin_site, model, admin_class=None):
-    " (re)registers a dynamic model in the given admin site "
+def _forget_registration(admin_site, model):
+    " Stops admin_urls() routing to the model's ModelAdmin. "
+    _admin_registrations.pop((admin_site.name, model._meta.app_label, model._meta.module_name), None)
+
+
+def reregister_in_admin(admin_site, model, admin_class=None, reload_urls=None, create_permissions=True):
+    """ (re)registers a dynamic model in the given admin site 
+        reload_urls can be disabled when the URL conf will be reloaded later,
+        it is disabled by default with DYMO_ADMIN_URL_DISPATCH.
+        create_permissions can be disabled when create_dynamic_permissions()
+        has already been run for the model.
+    """
 
     # We use our own unregister, to ensure that the correct
     # existing model is found 
     # (Django's unregister doesn't expect the model class to change)
-    unregister_from_admin(admin_site, model)
-    admin_site.register(model, admin_class)
+    with metrics.timer('dymo.admin.reregister_in_admin.unregister'):
+        unregister_from_admin(admin_site, model, reload_urls=False)
+    with metrics.timer('dymo.admin.reregister_in_admin.register'):
+        admin_site.register(model, admin_class)
+    opts = model._meta
+    _admin_registrations[(admin_site.name, opts.app_label, opts.module_name)] = admin_site._registry[model]
 
     # Add any missing permissions
-    create_permissions(models.get_app(model._meta.app_label), created_models=[], verbosity=0)
+    if create_permissions:
+        with metrics.timer('dymo.admin.reregister_in_admin.create_permissions'):
+            create_dynamic_permissions([model])
 
-    propogate_permissions(model)
+    with metrics.timer('dymo.admin.reregister_in_admin.propogate_permissions'):
+        propogate_permissions(model)
 
-    # Reload the URL conf and clear the URL cache
+    if reload_urls is None:
+        reload_urls = not ADMIN_URL_DISPATCH
+    if reload_urls:
+        reload_urlconf()
+
+    logger.debug("(Re-)Added %r model to admin" % model.__name__)
+
+
+@metrics.timed('dymo.admin.reload_urlconf')
+def reload_urlconf():
+    " Reloads the URL conf and clears the URL cache. "
     # It's important to use the same string as ROOT_URLCONF
     reload(import_module(settings.ROOT_URLCONF))
     clear_url_caches()
 
-    logger.debug("(Re-)Added %r model to admin" % model.__name__)
+
+class DynamicAdminResolver(RegexURLResolver):
+    """ Routes app_label/module_name/... to the current ModelAdmin of a dynamic
+        model, looked up at request time. Paths for other models are not 
+        matched, so that they fall through to the following patterns.
+        It has no URL patterns of its own, so adds nothing for reverse().
+    """
+    def __init__(self, admin_site):
+        super(DynamicAdminResolver, self).__init__(r'^(?P<app_label>\w+)/(?P<module_name>\w+)/', [])
+        self.admin_site = admin_site
+
+    def resolve(self, path):
+        match = self.regex.search(path)
+        if not match:
+            return None
+        key = (self.admin_site.name, match.group('app_label'), match.group('module_name'))
+        model_admin = _admin_registrations.get(key)
+        if model_admin is None:
+            return None
+        return self._get_resolver(model_admin).resolve(path[match.end():])
+
+    def _get_resolver(self, model_admin):
+        # The ModelAdmin is replaced when the model is re-registered, 
+        # so its URL patterns only need to be built once
+        try:
+            return model_admin._dymo_url_resolver
+        except AttributeError:
+            model_admin._dymo_url_resolver = RegexURLResolver(r'^', model_admin.urls)
+            return model_admin._dymo_url_resolver
+
+
+def admin_urls(admin_site):
+    """ Returns URL patterns for the dynamic models of the given admin site,
+        which don't need the URL conf to be reloaded when models change.
+        Include them before the admin site's own URLs and set 
+        DYMO_ADMIN_URL_DISPATCH, eg.
+
+            urlpatterns = patterns('',
+                (r'^admin/', include(dymo.admin_urls(admin.site))),
+                (r'^admin/', include(admin.site.urls)),
+            )
+
+        NB reverse() of the admin URL names of dynamic models still requires 
+        the URL conf to have been loaded after they were registered.
+    """
+    return [DynamicAdminResolver(admin_site)]
+
+
+def _get_content_types(keys):
+    " Returns {(app_label, model): ContentType} for the given keys, in one query. "
+    by_app_label = {}
+    for app_label, model_name in keys:
+        by_app_label.setdefault(app_label, []).append(model_name)
+    query = Q()
+    for app_label, model_names in by_app_label.items():
+        query |= Q(app_label=app_label, model__in=model_names)
+    return dict(((ct.app_label, ct.model), ct) for ct in ContentType.objects.filter(query))
+
+
+def _get_default_permissions(opts):
+    """ Returns (codename, name) for the default and custom permissions of
+        the given opts, as created by syncdb. 
+    """
+    permissions = [(u'%s_%s' % (action, opts.object_name.lower()), 
+                    u'Can %s %s' % (action, opts.verbose_name_raw))
+                        for action in ('add', 'change', 'delete')]
+    return permissions + list(opts.permissions)
+
+
+@metrics.timed('dymo.admin.create_dynamic_permissions')
+def create_dynamic_permissions(dynamic_models):
+    """ Creates the missing content types and default permissions of the
+        given dynamic models, unlike create_permissions() which goes through
+        every model of the app. Existing ones are fetched in one query each
+        and the rest are inserted together, in one transaction unless the 
+        caller manages the transaction. Where Django can fetch several 
+        content types at once, its content type cache is then warmed.
+        Returns the number of permissions created.
+    """
+    opts_by_key = dict(((m._meta.app_label, m._meta.object_name.lower()), m._meta) for m in dynamic_models)
+    if not opts_by_key:
+        return 0
+
+    if transaction.is_managed():
+        # Leave the caller's transaction to the caller
+        created_ctypes, created_permissions = _create_dynamic_permissions(opts_by_key)
+    else:
+        with transaction.commit_on_success():
+            created_ctypes, created_permissions = _create_dynamic_permissions(opts_by_key)
+
+    if hasattr(ContentType.objects, 'get_for_models'):
+        ContentType.objects.get_for_models(*dynamic_models)
+
+    metrics.incr('dymo.admin.create_dynamic_permissions.content_types', created_ctypes)
+    metrics.incr('dymo.admin.create_dynamic_permissions.permissions', created_permissions)
+    return created_permissions
+
+
+def _create_dynamic_permissions(opts_by_key):
+    """ Creates the missing content types and permissions for the given 
+        {(app_label, model name): opts}. Returns the numbers created. 
+    """
+    ctypes = _get_content_types(opts_by_key.keys())
+    new_ctypes = [ContentType(app_label=app_label, model=model_name, 
+                              name=smart_unicode(opts.verbose_name_raw))
+                    for (app_label, model_name), opts in opts_by_key.items()
+                    if (app_label, model_name) not in ctypes]
+    if new_ctypes:
+        bulk_save(ContentType, new_ctypes)
+        # bulk_create() doesn't set the primary keys
+        ctypes = _get_content_types(opts_by_key.keys())
+
+    existing = set(Permission.objects.filter(content_type__in=ctypes.values()
+                                    ).values_list("content_type", "codename"))
+    new_permissions = []
+    for key, opts in opts_by_key.items():
+        ctype = ctypes[key]
+        for codename, name in _get_default_permissions(opts):
+            if (ctype.pk, codename) not in existing:
+                new_permissions.append(Permission(codename=codename, name=name, content_type=ctype))
+    bulk_save(Permission, new_permissions)
+    return len(new_ctypes), len(new_permissions)
 
 
 def propogate_permissions(model):
@@ -96,8 +262,12 @@ def propogate_permissions(model):
         groups = set(perm.group_set.all().values_list('id', flat=True))
         users = set(perm.user_set.all().values_list('id', flat=True))
         req_groups, req_users  = directory[perm_type]
-        for group in Group.objects.filter(id__in=req_groups-groups):
+        new_groups = req_groups - groups
+        new_users = req_users - users
+        for group in Group.objects.filter(id__in=new_groups):
             group.permissions.add(perm)
-        for user in User.objects.filter(id__in=req_users-users):
+        for user in User.objects.filter(id__in=new_users):
             user.user_permissions.add(perm)
+        metrics.incr('dymo.admin.propogate_permissions.groups', len(new_groups))
+        metrics.incr('dymo.admin.propogate_permissions.users', len(new_users))
 
@@ -2,26 +2,50 @@
 # -*- coding: UTF-8 -*-
 
 import logging
-from south.db import db
-from django.db import connection, DatabaseError
+from south.db import dbs
+from django.db import connections, DatabaseError
 from django.db import models
+from django.conf import settings
+from django.core.management.color import no_style
+
+from .metrics import timed
+from .routing import get_database_for_model, DEFAULT_DB_ALIAS
+from .jobs import get_pending_renames
 
 logger = logging.getLogger('dymo')
 
+# Create indexes for new M2M tables after their transaction is committed,
+# concurrently where the backend supports it
+CONCURRENT_INDEXES = getattr(settings, "DYMO_CONCURRENT_INDEXES", False)
+CONCURRENT_INDEX_VENDORS = ('postgresql',)
+
 
-def update_table(model_class):
-    create_db_table(model_class)
-    add_necessary_db_columns(model_class)
+@timed('dymo.db.update_table')
+def update_table(model_class, using=None):
+    """ Creates the table and any missing columns, and brings the indexes in
+        line with the fields. Returns the index changes, see sync_db_indexes.
+    """
+    create_db_table(model_class, using)
+    add_necessary_db_columns(model_class, using)
+    return sync_db_indexes(model_class, using)
 
 
-def create_db_table(model_class):
+@timed('dymo.db.create_db_table')
+def create_db_table(model_class, using=None):
     """ Takes a Django model class and create a database table, if necessary.
+        The table is created on the database the model is placed on, see
+        dymo.routing, unless another alias is given.
     """
+    using = using or get_database_for_model(model_class)
+    db = dbs[using]
     table_name = model_class._meta.db_table
+    if get_pending_renames(table_name, using)[0]:
+        logger.debug("Table '%s' is waiting for a queued rename" % table_name)
+        return
+    table_names = _get_table_names(using)
 
     # Introspect the database to see if it doesn't already exist
-    if (connection.introspection.table_name_converter(table_name) 
-                        not in connection.introspection.table_names()):
+    if not _table_exists(table_name, table_names, using):
         db.start_transaction()
 
         fields = _get_fields(model_class)
@@ -33,13 +57,59 @@ def create_db_table(model_class):
         db.commit_transaction()
         logger.debug("Created table '%s'" % table_name)
 
-    create_auto_m2m_tables(model_class)
+    create_auto_m2m_tables(model_class, table_names, using=using)
 
     db.send_create_signal(model_class._meta.app_label, [model_class._meta.object_name])
 
 
-def create_auto_m2m_tables(model_class):
-    " Create tables for ManyToMany fields "
+@timed('dymo.db.create_auto_m2m_tables')
+def create_auto_m2m_tables(model_class, table_names=None, concurrent_indexes=CONCURRENT_INDEXES, using=None):
+    """ Create tables for ManyToMany fields.
+        All missing tables are created in one transaction, with their foreign
+        key constraints and indexes run together at the end. If 
+        concurrent_indexes is set, indexes are created after the commit
+        instead, concurrently if the backend supports it.
+        table_names is an optional set of existing tables, from introspection.
+    """
+    using = using or get_database_for_model(model_class)
+    db = dbs[using]
+    if table_names is None:
+        table_names = _get_table_names(using)
+
+    fields = [f for f in _get_auto_m2m_fields(model_class)
+                    if not _table_exists(f.m2m_db_table(), table_names, using)]
+    if not fields:
+        return
+
+    db.start_transaction()
+    for f in fields:
+        # Create the standard implied M2M table
+        m2m_table_name = f.m2m_db_table()
+        m2m_column_name = f.m2m_column_name()[:-3] # without "_id"
+        m2m_reverse_name = f.m2m_reverse_name()[:-3] # without "_id"
+        db.create_table(m2m_table_name, (
+            ('id', models.AutoField(verbose_name='ID', primary_key=True, auto_created=True)),
+            (m2m_column_name, models.ForeignKey(model_class, null=False)),
+            (m2m_reverse_name, models.ForeignKey(f.rel.to, null=False))
+        ))
+        db.create_unique(m2m_table_name, [f.m2m_column_name(), f.m2m_reverse_name()])
+        logger.debug("Created table '%s'" % m2m_table_name)
+
+    if concurrent_indexes:
+        index_sql = _pop_deferred_index_sql(db)
+    else:
+        index_sql = []
+
+    # Foreign key constraints and indexes were collected by db.create_table()
+    db.execute_deferred_sql()
+    db.commit_transaction()
+
+    if index_sql:
+        create_indexes(index_sql, using)
+
+
+def _get_auto_m2m_fields(model_class):
+    " Returns the M2M fields that use an implied (auto created) table. "
     for f in model_class._meta.many_to_many:
         if f.rel.through:
             try:
@@ -50,44 +120,251 @@ def create_auto_m2m_tables(model_class):
                 through = f.rel.through_model
 
         if (not f.rel.through) or getattr(through._meta, "auto_created", None):
+            yield f
 
-            # Create the standard implied M2M table
-            m2m_table_name = f.m2m_db_table()
-            if (connection.introspection.table_name_converter(m2m_table_name) 
-                        not in connection.introspection.table_names()):
-
-                db.start_transaction()
-                m2m_column_name = f.m2m_column_name()[:-3] # without "_id"
-                m2m_reverse_name = f.m2m_reverse_name()[:-3] # without "_id"
-                db.create_table(f.m2m_db_table(), (
-                    ('id', models.AutoField(verbose_name='ID', primary_key=True, auto_created=True)),
-                    (m2m_column_name, models.ForeignKey(model_class, null=False)),
-                    (m2m_reverse_name, models.ForeignKey(f.rel.to, null=False))
-                ))
-                db.create_unique(f.m2m_db_table(), [f.m2m_column_name(), f.m2m_reverse_name()])
-                #db.execute_deferred_sql()
+
+def _get_table_names(using=DEFAULT_DB_ALIAS):
+    " Returns the set of existing table names, from a single introspection. "
+    return set(connections[using].introspection.table_names())
+
+
+def _table_exists(table_name, table_names, using=DEFAULT_DB_ALIAS):
+    return connections[using].introspection.table_name_converter(table_name) in table_names
+
+
+def _pop_deferred_index_sql(db):
+    " Removes and returns any CREATE INDEX statements waiting in South's deferred SQL. "
+    index_sql = [sql for sql in db.deferred_sql if sql.lstrip().upper().startswith("CREATE INDEX")]
+    db.deferred_sql = [sql for sql in db.deferred_sql if sql not in index_sql]
+    return index_sql
+
+
+@timed('dymo.db.create_indexes')
+def create_indexes(statements, using=DEFAULT_DB_ALIAS):
+    """ Runs the given CREATE INDEX statements. Where the backend supports it,
+        indexes are built concurrently, which requires running outside of a
+        transaction. Otherwise they are run in a single transaction.
+    """
+    db = dbs[using]
+    connection = connections[using]
+    if connection.vendor not in CONCURRENT_INDEX_VENDORS:
+        db.start_transaction()
+        for sql in statements:
+            db.execute(sql)
+        db.commit_transaction()
+        return
+
+    cursor = connection.cursor()
+    old_isolation_level = connection.connection.isolation_level
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    connection.connection.set_isolation_level(0)
+    try:
+        for sql in statements:
+            sql = sql.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+            cursor.execute(sql)
+            logger.debug(sql)
+    finally:
+        connection.connection.set_isolation_level(old_isolation_level)
+
+
+INDEX_CREATED = 'create_index'
+INDEX_DROPPED = 'drop_index'
+UNIQUE_CREATED = 'create_unique'
+UNIQUE_DROPPED = 'drop_unique'
+# A unique constraint that couldn't be created, eg. because of duplicates
+UNIQUE_FAILED = 'create_unique_failed'
+
+
+def _get_indexes(connection, table_name):
+    """ Returns {column: {'unique': bool, 'indexed': bool, 'indexes': [names]}}
+        for the single column indexes of the table, other than the primary 
+        key. 'indexed' is True if there are indexes that aren't unique, and
+        'indexes' are their names, where they are known. 
+        Django's introspection doesn't give index names (and its SQLite 
+        backend lists every column), so the catalog is read directly.
+    """
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    rows = []
+    if connection.vendor == 'sqlite':
+        cursor.execute('PRAGMA index_list(%s)' % qn(table_name))
+        # seq, name, unique
+        for index_name, unique in [(row[1], row[2]) for row in cursor.fetchall()]:
+            cursor.execute('PRAGMA index_info(%s)' % qn(index_name))
+            info = cursor.fetchall()
+            if len(info) == 1:
+                # seqno, cid, name
+                rows.append((info[0][2], index_name, unique))
+    elif connection.vendor == 'postgresql':
+        cursor.execute("""
+            SELECT attr.attname, idx_class.relname, idx.indisunique
+            FROM pg_catalog.pg_index idx
+            JOIN pg_catalog.pg_class idx_class ON idx_class.oid = idx.indexrelid
+            JOIN pg_catalog.pg_class tbl ON tbl.oid = idx.indrelid
+            JOIN pg_catalog.pg_attribute attr ON attr.attrelid = tbl.oid AND attr.attnum = idx.indkey[0]
+            WHERE tbl.relname = %s AND pg_catalog.pg_table_is_visible(tbl.oid)
+                AND idx.indnatts = 1 AND NOT idx.indisprimary""", [table_name])
+        rows = cursor.fetchall()
+    elif connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % qn(table_name))
+        # Table, Non_unique, Key_name, Seq_in_index, Column_name, ...
+        keys = {}
+        for row in cursor.fetchall():
+            keys.setdefault(row[2], []).append((row[4], not row[1]))
+        rows = [(columns[0][0], key_name, columns[0][1]) for key_name, columns in keys.items()
+                        if len(columns) == 1 and key_name != 'PRIMARY']
+    else:
+        # Index names are unknown, so indexes can be created but not dropped
+        for column, info in connection.introspection.get_indexes(cursor, table_name).items():
+            if not info['primary_key']:
+                rows.append((column, None, info['unique']))
+
+    indexes = {}
+    for column, index_name, unique in rows:
+        index = indexes.setdefault(column, {'unique': False, 'indexed': False, 'indexes': []})
+        if unique:
+            index['unique'] = True
+        else:
+            index['indexed'] = True
+            if index_name is not None:
+                index['indexes'].append(index_name)
+    return indexes
+
+
+@timed('dymo.db.sync_db_indexes')
+def sync_db_indexes(model_class, using=None, concurrent_indexes=CONCURRENT_INDEXES):
+    """ Compares the db_index and unique options of the model's fields with 
+        the single column indexes of the table, creates the missing ones and
+        drops those that are no longer declared. Plain indexes are created 
+        as in create_db_table, concurrently if concurrent_indexes is set and
+        the backend supports it. Only the columns of current fields are 
+        considered, except those waiting for a queued rename. Plain indexes
+        on unique fields are dropped, as the constraint indexes the column.
+        Each unique constraint is changed in its own transaction, one that 
+        can't be created (eg. the column has duplicates) is reported as 
+        UNIQUE_FAILED and the column keeps its plain index.
+        Returns the changes as a list of (change, column name) pairs, 
+        eg. [(INDEX_CREATED, 'colour')].
+    """
+    using = using or get_database_for_model(model_class)
+    db = dbs[using]
+    connection = connections[using]
+    table_name = model_class._meta.db_table
+    table_pending, pending_columns = get_pending_renames(table_name, using)
+    if table_pending:
+        return []
+    fields = [f for f in model_class._meta.local_fields
+                    if not f.primary_key and f.column not in pending_columns]
+
+    changes = []
+    index_sql = []
+    failed = set()
+
+    existing = _get_indexes(connection, table_name)
+    for field in fields:
+        unique = existing.get(field.column, {}).get('unique', False)
+        if field.unique != unique:
+            db.start_transaction()
+            try:
+                if field.unique:
+                    db.create_unique(table_name, [field.column])
+                    changes.append((UNIQUE_CREATED, field.column))
+                else:
+                    db.delete_unique(table_name, [field.column])
+                    changes.append((UNIQUE_DROPPED, field.column))
+            except DatabaseError:
+                db.rollback_transaction()
+                if not field.unique:
+                    raise
+                logger.exception("Could not create a unique constraint on '%s.%s'" % (table_name, field.column))
+                changes.append((UNIQUE_FAILED, field.column))
+                failed.add(field.column)
+            else:
                 db.commit_transaction()
-                logger.debug("Created table '%s'" % m2m_table_name)
+
+    # Changing unique constraints can rebuild the table (SQLite), look again
+    if changes:
+        existing = _get_indexes(connection, table_name)
+    db.start_transaction()
+    try:
+        _sync_plain_indexes(db, connection, model_class, fields, existing, failed, changes, index_sql)
+        if not concurrent_indexes:
+            for sql in index_sql:
+                db.execute(sql)
+    except:
+        db.rollback_transaction()
+        raise
+    db.commit_transaction()
+
+    if concurrent_indexes and index_sql:
+        create_indexes(index_sql, using)
+
+    for change, column in changes:
+        logger.debug("Index change on '%s.%s': %s" % (table_name, column, change))
+    return changes
+
+
+def _sync_plain_indexes(db, connection, model_class, fields, existing, failed, changes, index_sql):
+    """ Drops the plain indexes that are no longer needed and adds the SQL 
+        for the missing ones to index_sql, see sync_db_indexes.
+    """
+    table_name = model_class._meta.db_table
+    for field in fields:
+        index = existing.get(field.column, {'indexed': False, 'indexes': []})
+        # Unique columns are already indexed by their constraint, those 
+        # without one keep any plain index
+        if field.column in failed:
+            wanted = field.db_index or index['indexed']
+        else:
+            wanted = field.db_index and not field.unique
+        if wanted and not index['indexed']:
+            index_sql.extend(connection.creation.sql_indexes_for_field(model_class, field, no_style()))
+            changes.append((INDEX_CREATED, field.column))
+        elif index['indexed'] and not wanted:
+            if not index['indexes']:
+                logger.warning("Index on '%s.%s' is no longer needed, but can't be dropped "
+                               "as its name is unknown" % (table_name, field.column))
+                continue
+            for index_name in index['indexes']:
+                db.execute(db.drop_index_string % {
+                    "index_name": db.quote_name(index_name),
+                    "table_name": db.quote_name(table_name),
+                })
+            changes.append((INDEX_DROPPED, field.column))
+
+
+def bulk_save(model, objs):
+    " Saves the given new instances, in one query where possible. "
+    if not objs:
+        return
+    if hasattr(model.objects, 'bulk_create'):
+        model.objects.bulk_create(objs)
+    else:
+        for obj in objs:
+            obj.save()
 
 
 DELETED_PREFIX = "_deleted_"
 
-def get_deleted_tables():
-    return [t for t in connection.introspection.table_names() 
+def get_deleted_tables(using=DEFAULT_DB_ALIAS):
+    return [t for t in connections[using].introspection.table_names() 
                                     if t.startswith(DELETED_PREFIX)]
 
-def get_deleted_columns(table_name):
+def get_deleted_columns(table_name, using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
     rows = connection.introspection.get_table_description(connection.cursor(), table_name)
     return [r[0] for r in rows if r[0].startswith(DELETED_PREFIX)]
 
 
-def delete_db_table(table_name):
-    db.delete_table(table_name)
+@timed('dymo.db.delete_db_table')
+def delete_db_table(table_name, using=DEFAULT_DB_ALIAS):
+    dbs[using].delete_table(table_name)
     logger.debug("Deleted table '%s'" % table_name)
 
 
-def delete_db_column(table_name, column_name):
-    db.delete_column(table_name, column_name)
+@timed('dymo.db.delete_db_column')
+def delete_db_column(table_name, column_name, using=DEFAULT_DB_ALIAS):
+    dbs[using].delete_column(table_name, column_name)
     logger.debug("Deleted column '%s.%s'" % (table_name, column_name))
 
 
@@ -96,23 +373,33 @@ def _get_fields(model_class):
     return [(f.name, f) for f in model_class._meta.local_fields]
 
 
-def add_necessary_db_columns(model_class):
+@timed('dymo.db.add_necessary_db_columns')
+def add_necessary_db_columns(model_class, using=None):
     """ Creates new table or relevant columns as necessary based on the model_class.
         No columns or data are renamed or removed.
         This is available in case a database exception occurs.
+        Columns (and tables) waiting for a queued rename are not created.
     """
+    using = using or get_database_for_model(model_class)
+    db = dbs[using]
+    connection = connections[using]
     db.start_transaction()
 
     # Create table if missing
-    create_db_table(model_class)
+    create_db_table(model_class, using)
 
     # Add field columns if missing
     table_name = model_class._meta.db_table
+    table_pending, pending_columns = get_pending_renames(table_name, using)
+    if table_pending:
+        db.commit_transaction()
+        return
     fields = _get_fields(model_class)
     db_column_names = [row[0] for row in connection.introspection.get_table_description(connection.cursor(), table_name)]
 
     for field_name, field in fields:
-        if field.column not in db_column_names:
+        # Columns waiting for a queued rename are created by the rename
+        if field.column not in db_column_names and field.column not in pending_columns:
             logger.debug("Adding field '%s' to table '%s'" % (field_name, table_name))
             db.add_column(table_name, field_name, field)
 
@@ -124,18 +411,50 @@ def add_necessary_db_columns(model_class):
     db.commit_transaction()
 
 
-def rename_db_column(table_name, old_name, new_name):
+@timed('dymo.db.rename_db_column')
+def rename_db_column(table_name, old_name, new_name, using=DEFAULT_DB_ALIAS):
     """ Rename a sensor's database column. """
+    db = dbs[using]
     db.start_transaction()
     db.rename_column(table_name, old_name, new_name) 
     logger.debug("Renamed column '%s' to '%s' on %s" % (old_name, new_name, table_name))
     db.commit_transaction()
 
 
-def rename_db_table(old_table_name, new_table_name):
+@timed('dymo.db.rename_db_columns')
+def rename_db_columns(table_name, renames, using=DEFAULT_DB_ALIAS):
+    """ Rename several columns of a table, given as (old_name, new_name) pairs,
+        in a single transaction.
+    """
+    db = dbs[using]
+    db.start_transaction()
+    for old_name, new_name in renames:
+        db.rename_column(table_name, old_name, new_name) 
+        logger.debug("Renamed column '%s' to '%s' on %s" % (old_name, new_name, table_name))
+    db.commit_transaction()
+
+
+@timed('dymo.db.rename_db_table')
+def rename_db_table(old_table_name, new_table_name, using=DEFAULT_DB_ALIAS):
     """ Rename a sensor's database column. """
+    db = dbs[using]
     db.start_transaction()
     db.rename_table(old_table_name, new_table_name)
     logger.debug("Renamed table '%s' to '%s'" % (old_table_name, new_table_name))
     db.commit_transaction()
 
+
+@timed('dymo.db.rename_db_tables')
+def rename_db_tables(renames, using=DEFAULT_DB_ALIAS):
+    """ Rename several tables, given as (old_name, new_name) pairs, in a 
+        single transaction.
+    """
+    if not renames:
+        return
+    db = dbs[using]
+    db.start_transaction()
+    for old_table_name, new_table_name in renames:
+        db.rename_table(old_table_name, new_table_name)
+        logger.debug("Renamed table '%s' to '%s'" % (old_table_name, new_table_name))
+    db.commit_transaction()
+
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Streaming export of dynamic tables.
+
+    Tables are read in chunks ordered by primary key (keyset pagination),
+    without building model instances, and written out through generators,
+    so memory use does not depend on the size of the table.
+"""
+
+import os
+import csv
+import logging
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.db import connections
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import metrics
+from .routing import get_database_for_model
+
+logger = logging.getLogger('dymo')
+
+CHUNK_SIZE = 2000
+
+
+def iter_rows(model, chunk_size=CHUNK_SIZE):
+    """ Yields a tuple of column values for each row in the model's table.
+        Only chunk_size rows are fetched at a time.
+    """
+    fields = model._meta.local_fields
+    connection = connections[get_database_for_model(model)]
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    pk_index = fields.index(model._meta.pk)
+    select = "SELECT %s FROM %s" % (", ".join(qn(f.column) for f in fields), qn(model._meta.db_table))
+
+    cursor = connection.cursor()
+    last_pk = None
+    while True:
+        if last_pk is None:
+            cursor.execute("%s ORDER BY %s LIMIT %d" % (select, pk_column, chunk_size))
+        else:
+            cursor.execute("%s WHERE %s > %%s ORDER BY %s LIMIT %d" % (select, pk_column, pk_column, chunk_size), [last_pk])
+        rows = cursor.fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        last_pk = rows[-1][pk_index]
+
+
+def get_column_names(model):
+    return [f.column for f in model._meta.local_fields]
+
+
+def export_csv(model, chunk_size=CHUNK_SIZE, encoding='utf-8'):
+    " Yields the model's table as lines of CSV, starting with a header row. "
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(get_column_names(model))
+    for row in iter_rows(model, chunk_size):
+        writer.writerow([_encode(v, encoding) for v in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    # The header, if the table is empty
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def export_json_lines(model, chunk_size=CHUNK_SIZE):
+    " Yields the model's table as lines of JSON objects. "
+    names = get_column_names(model)
+    for row in iter_rows(model, chunk_size):
+        yield json.dumps(dict(zip(names, row)), cls=DjangoJSONEncoder) + "\n"
+
+
+EXPORTERS = {
+    'csv': (export_csv, 'csv'),
+    'json': (export_json_lines, 'jsonl'),
+}
+
+
+def export_to_file(model, path, format='csv', chunk_size=CHUNK_SIZE):
+    """ Writes the model's table to the given file. """
+    exporter, ext = EXPORTERS[format]
+    f = open(path, 'wb')
+    try:
+        with metrics.timer('dymo.export.export_to_file'):
+            for line in exporter(model, chunk_size):
+                f.write(line)
+    finally:
+        f.close()
+    logger.debug("Exported '%s' to '%s'" % (model._meta.db_table, path))
+    return path
+
+
+def export_models(models, directory, format='csv', chunk_size=CHUNK_SIZE, workers=1):
+    """ Exports each model's table to a file named after the table in the
+        given directory, using a pool of threads if workers > 1.
+        Returns the paths of the written files.
+    """
+    ext = EXPORTERS[format][1]
+    jobs = [(m, os.path.join(directory, "%s.%s" % (m._meta.db_table, ext))) for m in models]
+
+    if workers <= 1:
+        return [export_to_file(m, path, format, chunk_size) for m, path in jobs]
+
+    def export(job):
+        model, path = job
+        try:
+            return export_to_file(model, path, format, chunk_size)
+        finally:
+            # Each thread has its own database connection
+            connections[get_database_for_model(model)].close()
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(export, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _encode(value, encoding):
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    return value
@@ -2,6 +2,7 @@
 # -*- coding: UTF-8 -*-
 
 from django.db import models, connection
+from django.db.models.loading import cache as app_cache
 from django.utils.translation import ugettext_lazy as _
 
 from .validation import validate_identifier_slug
@@ -24,16 +25,64 @@ class IdentifierSlugField(models.CharField):
         return ('django.db.models.fields.CharField', args, kwargs)
 
 
+def _natural_key(model):
+    return (model._meta.app_label, model._meta.object_name.lower())
+
+
+def clear_m2m_attr_cache(app_label, model_name):
+    """ Forgets any resolved m2m relations involving the given model, either 
+        as the model holding the field or as the related model, for the 
+        classes in the app cache. Classes that were removed keep theirs, 
+        as they still query their own through model.
+    """
+    model_key = (app_label, model_name.lower())
+    for app_models in app_cache.app_models.values():
+        for model in app_models.values():
+            for field in model._meta.local_many_to_many:
+                if not isinstance(field, ManyToManyField) or isinstance(field.rel.to, basestring):
+                    continue
+                if _natural_key(model) == model_key or _natural_key(field.rel.to) == model_key:
+                    field._m2m_fields = None
+
+
 class ManyToManyField(models.ManyToManyField):
+    # The through model's foreign key to each related model, keyed on the 
+    # related model's natural key. Django curries _get_m2m_attr for several 
+    # attributes of that foreign key (name, column, rel), which are read 
+    # from it. The map is kept on the field, so that each generation of a
+    # regenerated class resolves its own through model.
+    _m2m_fields = None
+
+    def south_field_triple(self):
+        " Returns a description of this field for DB migrations with South. "
+        from south.modelsinspector import introspector
+        args, kwargs = introspector(self)
+        return ('dymo.fields.ManyToManyField', args, kwargs)
+
+    def contribute_to_related_class(self, cls, related):
+        super(ManyToManyField, self).contribute_to_related_class(cls, related)
+        # Build the map if the through model has already been prepared, it
+        # is created after this when the related model is a class
+        if self.rel.through is not None and not isinstance(self.rel.through, basestring):
+            self._prepare_m2m_fields()
+
     def _get_m2m_attr(self, related, attr):
         "Function that can be curried to provide the source accessor or DB column name for the m2m table"
-        cache_attr = '_m2m_%s_cache' % attr
-        related_tuple = (related.model._meta.app_label, related.model._meta.object_name)
-        if hasattr(self, cache_attr):
-            return getattr(self, cache_attr)
-        for f in self.rel.through._meta.fields:
-            if hasattr(f,'rel') and f.rel:
-                if (f.rel.to._meta.app_label, f.rel.to._meta.object_name) == related_tuple:
-                    setattr(self, cache_attr, getattr(f, attr))
-                    return getattr(self, cache_attr)
+        related_key = _natural_key(related.model)
+        if self._m2m_fields is None or related_key not in self._m2m_fields:
+            self._prepare_m2m_fields()
+        f = self._m2m_fields.get(related_key)
+        if f is None:
+            return None
+        return getattr(f, attr)
 
+    def _prepare_m2m_fields(self):
+        """ Finds the through model's relations in one pass, replacing any
+            previous map. For self-referential relations, the first relation
+            found is the source, as in Django.
+        """
+        m2m_fields = {}
+        for f in self.rel.through._meta.fields:
+            if hasattr(f,'rel') and f.rel and not isinstance(f.rel.to, basestring):
+                m2m_fields.setdefault(_natural_key(f.rel.to), f)
+        self._m2m_fields = m2m_fields
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Queue for schema changes, run outside of the request.
+
+    When DYMO_QUEUE_SCHEMA_CHANGES is set, the migration signals record
+    their renames and soft deletes as SchemaJob rows instead of running
+    them. The dymo_schema_worker command runs the pending jobs in order,
+    and notifies other processes of the model change only once the
+    database has been changed. Run a single worker, so that the changes
+    to a table are made in the order they were queued.
+
+    When a job fails, the later jobs for its table are held back until it
+    is retried (see retry_failed_jobs), so that they are not made on top 
+    of a missing change.
+"""
+
+import time
+import logging
+import traceback
+from datetime import datetime
+from django.db import connections, reset_queries, DEFAULT_DB_ALIAS
+
+from .models import SchemaJob
+from .sync import notify_model_change
+from . import metrics
+
+logger = logging.getLogger('dymo')
+
+
+def enqueue(operation, table_name, old_name="", new_name="", app_label="", object_name="", using=DEFAULT_DB_ALIAS):
+    """ Records a schema change, to be run by the worker on the given database. """
+    job = SchemaJob.objects.create(operation=operation, table_name=table_name,
+                old_name=old_name, new_name=new_name or "",
+                app_label=app_label or "", object_name=object_name or "",
+                database=using)
+    metrics.incr('dymo.jobs.enqueued')
+    logger.debug("Queued schema job %s" % job)
+    return job
+
+
+def get_job_status(job_id):
+    """ Returns the status of the given job, or None if there is no such job. """
+    try:
+        return SchemaJob.objects.values_list('status', flat=True).get(pk=job_id)
+    except SchemaJob.DoesNotExist:
+        return None
+
+
+def get_pending_jobs(app_label=None, object_name=None):
+    """ Returns the jobs that have not yet been run, optionally for one model. """
+    jobs = SchemaJob.objects.filter(status__in=(SchemaJob.PENDING, SchemaJob.RUNNING))
+    if app_label is not None:
+        jobs = jobs.filter(app_label=app_label)
+    if object_name is not None:
+        jobs = jobs.filter(object_name=object_name)
+    return jobs
+
+
+def get_pending_renames(table_name, using=DEFAULT_DB_ALIAS):
+    """ Returns whether the given table name is the new name of a queued 
+        table rename, and the new names of the queued renames of its columns.
+        These don't exist until the worker has run the jobs, so they must 
+        not be created meanwhile (the renames would then fail, and the data
+        would be split). Failed renames are included, until retried.
+    """
+    if SchemaJob is None:
+        return False, set()
+    jobs = SchemaJob.objects.filter(database=using,
+                status__in=(SchemaJob.PENDING, SchemaJob.RUNNING, SchemaJob.FAILED))
+    table_pending = jobs.filter(operation=SchemaJob.RENAME_TABLE, new_name=table_name).exists()
+    columns = set(jobs.filter(operation=SchemaJob.RENAME_COLUMN, table_name=table_name
+                                ).values_list('new_name', flat=True))
+    return table_pending, columns
+
+
+def run_job(job):
+    """ Runs the given job, unless another worker has already claimed it.
+        Returns True if the job was run successfully.
+    """
+    claimed = SchemaJob.objects.filter(pk=job.pk, status=SchemaJob.PENDING).update(
+                    status=SchemaJob.RUNNING, started=datetime.now())
+    if not claimed:
+        return False
+
+    try:
+        with metrics.timer('dymo.jobs.%s' % job.operation):
+            _run_operation(job)
+    except Exception:
+        logger.exception("Schema job %s failed" % job.pk)
+        SchemaJob.objects.filter(pk=job.pk).update(status=SchemaJob.FAILED,
+                    error=traceback.format_exc(), finished=datetime.now())
+        metrics.incr('dymo.jobs.failed')
+        return False
+
+    SchemaJob.objects.filter(pk=job.pk).update(status=SchemaJob.DONE, finished=datetime.now())
+    metrics.incr('dymo.jobs.done')
+
+    # The database has now been changed
+    if job.app_label and job.object_name:
+        notify_model_change(app_label=job.app_label, object_name=job.object_name, invalidate_only=True)
+    return True
+
+
+def _run_operation(job):
+    from .db import rename_db_table, rename_db_column
+    from .signals import apply_column_changes, soft_delete_tables
+
+    if job.operation == SchemaJob.RENAME_TABLE:
+        rename_db_table(job.old_name, job.new_name, job.database)
+    elif job.operation == SchemaJob.RENAME_COLUMN:
+        rename_db_column(job.table_name, job.old_name, job.new_name, job.database)
+    elif job.operation == SchemaJob.DELETE_TABLE:
+        soft_delete_tables([job.table_name], job.database)
+    elif job.operation == SchemaJob.DELETE_COLUMN:
+        apply_column_changes({job.table_name: [(job.old_name, None)]}, job.database)
+    else:
+        raise ValueError("Unknown schema job operation: %s" % job.operation)
+
+
+def run_pending_jobs():
+    """ Runs all pending jobs in the order they were queued, except those 
+        for tables with a failed job. Returns the number of jobs run 
+        successfully.
+    """
+    failed = set(SchemaJob.objects.filter(status=SchemaJob.FAILED).values_list('database', 'table_name'))
+    count = 0
+    for job in list(SchemaJob.objects.filter(status=SchemaJob.PENDING).order_by('id')):
+        table = (job.database, job.table_name)
+        if table in failed:
+            logger.debug("Holding back schema job %s, after a failed job for its table" % job.pk)
+            continue
+        if run_job(job):
+            count += 1
+        elif get_job_status(job.pk) == SchemaJob.FAILED:
+            failed.add(table)
+    return count
+
+
+def retry_failed_jobs(table_name=None, using=None):
+    """ Queues the failed jobs again, optionally for one table only, once 
+        the cause has been fixed. Returns the number of jobs queued.
+    """
+    jobs = SchemaJob.objects.filter(status=SchemaJob.FAILED)
+    if table_name is not None:
+        jobs = jobs.filter(table_name=table_name)
+    if using is not None:
+        jobs = jobs.filter(database=using)
+    return jobs.update(status=SchemaJob.PENDING, error="", started=None, finished=None)
+
+
+def recover_running_jobs():
+    """ Queues the jobs left running by a worker that stopped, again. Only 
+        call this when no other worker is running. A change that was made
+        before the worker stopped will then fail, and hold back its table.
+    """
+    jobs = SchemaJob.objects.filter(status=SchemaJob.RUNNING)
+    for job in jobs:
+        logger.warning("Schema job %s was left running, queueing it again" % job.pk)
+    return jobs.update(status=SchemaJob.PENDING, started=None)
+
+
+def run_worker(interval=1.0, once=False):
+    """ Runs pending jobs, polling the queue every interval seconds. The 
+        jobs left running by a previous worker are queued again first.
+    """
+    recover_running_jobs()
+    while True:
+        run_pending_jobs()
+        if once:
+            return
+        # Don't hold connections (or the DEBUG query log) between polls
+        reset_queries()
+        for c in connections.all():
+            c.close()
+        time.sleep(interval)
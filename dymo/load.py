@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Bulk loading of data into dynamic tables.
+
+    Rows are streamed from a file, converted and validated with the model's
+    fields and inserted in batches with the backend's executemany(), inside
+    a single transaction. Rows that fail validation are passed to a rejects
+    callback (eg. RejectWriter) instead of stopping the load.
+"""
+
+import csv
+import logging
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.db import connections, transaction, models
+from django.core.exceptions import ValidationError
+
+from . import metrics
+from .routing import get_database_for_model
+
+logger = logging.getLogger('dymo')
+
+BATCH_SIZE = 1000
+
+
+def read_csv(f, encoding='utf-8'):
+    " Yields rows from a CSV file with a header row, as dictionaries. "
+    for row in csv.DictReader(f):
+        yield dict((k, v.decode(encoding) if v is not None else v) for k, v in row.items())
+
+
+class MalformedRow(dict):
+    """ Stands in for a line that couldn't be read, so that it is rejected
+        (with the raw line) instead of stopping the load.
+    """
+    def __init__(self, line, error):
+        super(MalformedRow, self).__init__(_line=line)
+        self.errors = [error]
+
+
+def read_json_lines(f):
+    " Yields rows from a file with one JSON object per line. "
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                row = json.loads(line)
+            except ValueError, e:
+                yield MalformedRow(line, "Invalid JSON: %s" % e)
+                continue
+            if not isinstance(row, dict):
+                yield MalformedRow(line, "Not a JSON object")
+                continue
+            yield row
+
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json_lines,
+}
+
+
+class RejectWriter(object):
+    """ Writes rejected rows to a CSV file, with a column for each of the
+        model's fields, the raw line of malformed rows and the errors.
+    """
+    LINE_COLUMN = '_line'
+    ERROR_COLUMN = '_errors'
+
+    def __init__(self, f, model, encoding='utf-8'):
+        self.f = f
+        self.fields = model._meta.local_fields
+        self.encoding = encoding
+        self.writer = None
+
+    def __call__(self, row, errors):
+        if self.writer is None:
+            fieldnames = [f.name for f in self.fields] + [self.LINE_COLUMN, self.ERROR_COLUMN]
+            self.writer = csv.DictWriter(self.f, fieldnames, extrasaction='ignore')
+            self.writer.writerow(dict((n, n) for n in fieldnames))
+        row = dict(row)
+        # Rows may be keyed on attname, eg. colour_id
+        for field in self.fields:
+            if field.name not in row and field.attname in row:
+                row[field.name] = row[field.attname]
+        row[self.ERROR_COLUMN] = "; ".join(errors)
+        self.writer.writerow(dict((k, self._encode(v)) for k, v in row.items()))
+
+    def _encode(self, value):
+        if isinstance(value, unicode):
+            return value.encode(self.encoding)
+        return value
+
+
+def _get_load_fields(model):
+    " Returns the fields to be loaded, the auto created primary key is left to the database. "
+    return [f for f in model._meta.local_fields if not (f.primary_key and f.auto_created)]
+
+
+def _clean(field, value):
+    " As field.clean(), but ForeignKey values are checked per batch instead. "
+    if isinstance(field, models.ForeignKey):
+        # ForeignKey.to_python() leaves values as they are, eg. CSV strings
+        value = field.rel.get_related_field().to_python(value)
+        models.Field.validate(field, value, None)
+        field.run_validators(value)
+        return value
+    return field.clean(value, None)
+
+
+def clean_row(fields, row):
+    """ Returns the values for the given row, using the model's fields
+        to convert and validate each value. Raises ValidationError with the
+        messages for every invalid value. Foreign keys are not checked 
+        against the related table, see check_foreign_keys.
+    """
+    values = []
+    errors = []
+    for field in fields:
+        if field.name in row:
+            value = row[field.name]
+        elif field.attname in row:
+            value = row[field.attname]
+        else:
+            value = field.get_default()
+
+        if value == '' and field.null:
+            value = None
+
+        try:
+            values.append(_clean(field, value))
+        except ValidationError, e:
+            errors.extend("%s: %s" % (field.name, m) for m in e.messages)
+
+    if errors:
+        raise ValidationError(errors)
+    return values
+
+
+def check_foreign_keys(fields, batch):
+    """ Checks that the foreign keys of a batch of cleaned rows exist, with 
+        one query per ForeignKey. Returns {index in batch: [messages]} for 
+        the rows with missing related objects.
+    """
+    errors = {}
+    for i, field in enumerate(fields):
+        if not isinstance(field, models.ForeignKey):
+            continue
+        keys = set(values[i] for values in batch if values[i] is not None)
+        if not keys:
+            continue
+        lookup = '%s__in' % field.rel.field_name
+        existing = set(field.rel.to._default_manager.filter(**{lookup: keys}
+                                ).values_list(field.rel.field_name, flat=True))
+        for n, values in enumerate(batch):
+            if values[i] is not None and values[i] not in existing:
+                message = field.error_messages['invalid'] % {
+                        'model': field.rel.to._meta.verbose_name, 'pk': values[i]}
+                errors.setdefault(n, []).append("%s: %s" % (field.name, message))
+    return errors
+
+
+def load_rows(model, rows, batch_size=BATCH_SIZE, rejects=None, progress=None):
+    """ Inserts the given rows (dictionaries keyed on field name or attname)
+        into the model's table, in batches, in a single transaction.
+        rejects(row, messages) is called for each invalid row,
+        progress(loaded, rejected) after each batch.
+        Returns the number of loaded and rejected rows.
+    """
+    fields = _get_load_fields(model)
+    using = get_database_for_model(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+                qn(model._meta.db_table),
+                ", ".join(qn(f.column) for f in fields),
+                ", ".join(["%s"] * len(fields)))
+
+    counts = {'loaded': 0, 'rejected': 0}
+    batch = []
+    batch_rows = []
+
+    def reject(row, messages):
+        counts['rejected'] += 1
+        if rejects is not None:
+            rejects(row, messages)
+
+    def flush():
+        errors = check_foreign_keys(fields, batch)
+        params = []
+        for n, (row, values) in enumerate(zip(batch_rows, batch)):
+            if n in errors:
+                reject(row, errors[n])
+            else:
+                params.append([f.get_db_prep_save(v, connection=connection) for f, v in zip(fields, values)])
+        if params:
+            cursor.executemany(sql, params)
+        counts['loaded'] += len(params)
+        del batch[:], batch_rows[:]
+        if progress is not None:
+            progress(counts['loaded'], counts['rejected'])
+
+    with transaction.commit_on_success(using=using):
+        cursor = connection.cursor()
+        with metrics.timer('dymo.load.load_rows'):
+            for row in rows:
+                if isinstance(row, MalformedRow):
+                    reject(row, row.errors)
+                    continue
+                try:
+                    batch.append(clean_row(fields, row))
+                except ValidationError, e:
+                    reject(row, e.messages)
+                else:
+                    batch_rows.append(row)
+
+                if len(batch) >= batch_size:
+                    flush()
+
+            if batch:
+                flush()
+
+    loaded, rejected = counts['loaded'], counts['rejected']
+    metrics.incr('dymo.load.loaded', loaded)
+    metrics.incr('dymo.load.rejected', rejected)
+    logger.debug("Loaded %d rows into '%s', %d rejected" % (loaded, model._meta.db_table, rejected))
+    return loaded, rejected
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...registry import get_dynamic_model, get_dynamic_models
+from ...export import export_models, EXPORTERS, CHUNK_SIZE
+
+class Command(BaseCommand):
+    """
+    Management Command for django
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', '-f', default='csv', dest='format', choices=EXPORTERS.keys(),
+            help='Format of the files: csv or json (one object per line).'),
+        make_option('--output-dir', '-o', default='.', dest='directory',
+            help='Directory for the exported files, which are named after the tables.'),
+        make_option('--chunk-size', '-c', default=CHUNK_SIZE, type='int', dest='chunk_size',
+            help='Number of rows read from the database at a time.'),
+        make_option('--workers', '-w', default=1, type='int', dest='workers',
+            help='Number of tables exported in parallel.'),
+    )
+    help = 'Export the contents of dynamic tables (all of them, if no models are given).'
+    args = '[app_label.ModelName ...]'
+
+    def handle(self, *args, **options):
+        if args:
+            models = []
+            for name in args:
+                model = get_dynamic_model(name)
+                if model is None:
+                    raise CommandError("Unknown dynamic model: %s" % name)
+                models.append(model)
+        else:
+            models = list(get_dynamic_models())
+
+        paths = export_models(models, options['directory'], options['format'],
+                        options['chunk_size'], options['workers'])
+
+        if int(options.get('verbosity', 1)) > 0:
+            for path in paths:
+                print path
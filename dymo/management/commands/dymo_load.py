@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...registry import get_dynamic_model
+from ...load import load_rows, READERS, RejectWriter, BATCH_SIZE
+
+class Command(BaseCommand):
+    """
+    Management Command for django
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', '-f', default='csv', dest='format', choices=READERS.keys(),
+            help='Format of the file: csv (with a header row) or json (one object per line).'),
+        make_option('--batch-size', '-b', default=BATCH_SIZE, type='int', dest='batch_size',
+            help='Number of rows inserted at a time.'),
+        make_option('--rejects', '-r', default=None, dest='rejects',
+            help='Write rows that fail validation to this CSV file.'),
+    )
+    help = 'Bulk load rows from a file into the table of a dynamic model.'
+    args = '<app_label.ModelName> <filename>'
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: %s" % self.args)
+        model_name, filename = args
+
+        model = get_dynamic_model(model_name)
+        if model is None:
+            raise CommandError("Unknown dynamic model: %s" % model_name)
+
+        verbosity = int(options.get('verbosity', 1))
+        def progress(loaded, rejected):
+            if verbosity > 0:
+                sys.stderr.write("\r%d loaded, %d rejected" % (loaded, rejected))
+
+        rejects_file = None
+        rejects = None
+        if options['rejects']:
+            rejects_file = open(options['rejects'], 'wb')
+            rejects = RejectWriter(rejects_file, model)
+
+        f = open(filename, 'rb')
+        try:
+            rows = READERS[options['format']](f)
+            load_rows(model, rows, options['batch_size'], rejects, progress)
+        finally:
+            f.close()
+            if rejects_file is not None:
+                rejects_file.close()
+
+        if verbosity > 0:
+            sys.stderr.write("\n")
+
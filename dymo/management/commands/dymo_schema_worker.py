@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import QUEUE_SCHEMA_CHANGES
+from ...jobs import run_worker, retry_failed_jobs
+
+class Command(BaseCommand):
+    """
+    Management Command for django
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', default=False, action="store_true", dest="once",
+            help='Run the pending jobs and exit, instead of polling for new ones.'),
+        make_option('--interval', '-i', default=1.0, type='float', dest='interval',
+            help='Seconds between polls of the job queue.'),
+        make_option('--retry', default=False, action="store_true", dest="retry",
+            help='Queue the failed jobs again first.'),
+    )
+    help = 'Run queued schema changes for dynamic models (DYMO_QUEUE_SCHEMA_CHANGES).'
+
+    def handle(self, *args, **options):
+        if not QUEUE_SCHEMA_CHANGES:
+            raise CommandError("Schema changes are not queued, set DYMO_QUEUE_SCHEMA_CHANGES.")
+        if options['retry']:
+            retry_failed_jobs()
+        run_worker(options['interval'], options['once'])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Counters and timers for dymo operations.
+
+    By default nothing is recorded. To collect metrics, set a backend,
+    either with set_metrics_backend() or with the DYMO_METRICS_BACKEND
+    setting (a dotted path to a class). A backend has the methods
+    incr(name, count) and timing(name, milliseconds), much like a statsd
+    client, so one can be adapted easily.
+
+    eg.
+        from dymo.metrics import MemoryMetrics, set_metrics_backend
+        metrics = MemoryMetrics()
+        set_metrics_backend(metrics)
+        ...
+        metrics.counters['dymo.get_cached_model.hit']
+"""
+
+import time
+import logging
+from functools import wraps
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.importlib import import_module
+
+logger = logging.getLogger('dymo')
+
+
+class NullMetrics(object):
+    """ Default backend, which records nothing. """
+
+    def incr(self, name, count=1):
+        pass
+
+    def timing(self, name, milliseconds):
+        pass
+
+
+class MemoryMetrics(NullMetrics):
+    """ Keeps counters and timings in memory, logging each one at debug level.
+        Useful for tests, benchmarks and debugging.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+        logger.debug("%s +%d" % (name, count))
+
+    def timing(self, name, milliseconds):
+        self.timings.setdefault(name, []).append(milliseconds)
+        logger.debug("%s %.3fms" % (name, milliseconds))
+
+    def total_time(self, name):
+        return sum(self.timings.get(name, ()))
+
+
+def _load_backend():
+    path = getattr(settings, "DYMO_METRICS_BACKEND", None)
+    if not path:
+        return NullMetrics()
+    module_name, class_name = path.rsplit(".", 1)
+    return getattr(import_module(module_name), class_name)()
+
+
+_backend = None
+
+def get_metrics_backend():
+    global _backend
+    if _backend is None:
+        _backend = _load_backend()
+    return _backend
+
+
+def set_metrics_backend(backend):
+    """ Sets the backend for all dymo metrics, None returns to the default. """
+    global _backend
+    _backend = backend
+
+
+def incr(name, count=1):
+    get_metrics_backend().incr(name, count)
+
+
+@contextmanager
+def timer(name):
+    """ Context manager that records the time taken by its block. """
+    start = time.time()
+    try:
+        yield
+    finally:
+        get_metrics_backend().timing(name, (time.time() - start) * 1000)
+
+
+def timed(name):
+    """ Decorator that records the time taken by each call. """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
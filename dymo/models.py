@@ -68,3 +68,62 @@ if MANAGE_DELETIONS:
 else:
     DeletedTable = None
     DeletedColumn = None
+
+
+# Schema changes are queued and run by the dymo_schema_worker command,
+# instead of during the request that changed the definition
+QUEUE_SCHEMA_CHANGES = getattr(settings, "DYMO_QUEUE_SCHEMA_CHANGES", False)
+
+if QUEUE_SCHEMA_CHANGES:
+
+    class SchemaJob(models.Model):
+        """ A queued schema change, see dymo.jobs """
+        PENDING = 'pending'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+        STATUS_CHOICES = (
+            (PENDING, _("pending")),
+            (RUNNING, _("running")),
+            (DONE, _("done")),
+            (FAILED, _("failed")),
+        )
+
+        RENAME_TABLE = 'rename_table'
+        RENAME_COLUMN = 'rename_column'
+        DELETE_TABLE = 'delete_table'
+        DELETE_COLUMN = 'delete_column'
+        OPERATION_CHOICES = (
+            (RENAME_TABLE, _("rename table")),
+            (RENAME_COLUMN, _("rename column")),
+            (DELETE_TABLE, _("soft delete table")),
+            (DELETE_COLUMN, _("soft delete column")),
+        )
+
+        operation   = models.CharField(_("operation"), max_length=32, choices=OPERATION_CHOICES)
+        table_name  = models.CharField(_("table name"), max_length=127)
+        old_name    = models.CharField(_("old name"), max_length=127, default="", blank=True)
+        new_name    = models.CharField(_("new name"), max_length=127, default="", blank=True)
+        # The dynamic model to notify of the change, once it is done
+        app_label   = models.CharField(_("app label"), max_length=127, default="", blank=True)
+        object_name = models.CharField(_("object name"), max_length=127, default="", blank=True)
+        # The database alias the table is on, see dymo.routing
+        database    = models.CharField(_("database"), max_length=127, default="default")
+
+        status      = models.CharField(_("status"), max_length=16, db_index=True,
+                                    choices=STATUS_CHOICES, default=PENDING)
+        error       = models.TextField(_("error"), default="", blank=True)
+        created     = models.DateTimeField(_("created"), default=datetime.now, editable=False)
+        started     = models.DateTimeField(_("started"), null=True, blank=True, editable=False)
+        finished    = models.DateTimeField(_("finished"), null=True, blank=True, editable=False)
+
+        def __unicode__(self):
+            return u"%s %s (%s)" % (self.operation, self.table_name, self.status)
+
+        class Meta:
+            verbose_name = _("schema job")
+            verbose_name_plural = _("schema jobs")
+            ordering = ('id',)
+
+else:
+    SchemaJob = None
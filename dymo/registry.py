@@ -1,22 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import gc
+from django.db import connections
 from django.db.models.signals import class_prepared
 from django.db.models.loading import cache as app_cache
 from django.db.utils import DatabaseError
+from django.core.cache import cache
+from django.core.urlresolvers import get_resolver
 from south.db import db
 
+from .warmstart import warm_start, WARM_START_FILE
+from .sync import HASH_CACHE_TEMPLATE, get_invalidation_count, get_invalidation
+
 
 _dynamic_model_registry = {}
 
-def register_dynamic_models(app_label, name, dependencies, get_models_fn):
+def register_dynamic_models(app_label, name, dependencies, get_models_fn, attrs_fn=None):
     """ Register a class of dynamic models, by linking a function that returns
         an iterable of dynamic models. 
+        If DYMO_WARM_START_FILE is set, the models are built from that file
+        on startup when it is current, see dymo.warmstart (attrs_fn is 
+        passed on to warm_start).
     """
     _dynamic_model_registry[name] = get_models_fn
 
+    def build_models():
+        if WARM_START_FILE and warm_start(name, attrs_fn=attrs_fn) is not None:
+            return
+        get_models_fn()
+
     # Build all models as soon as possible
-    when_classes_prepared(app_label, dependencies, get_models_fn)
+    when_classes_prepared(app_label, dependencies, build_models)
 
 
 def get_dynamic_models(*names):
@@ -27,6 +42,73 @@ def get_dynamic_models(*names):
             yield model
 
 
+def get_dynamic_model(name):
+    """ Returns the registered dynamic model with the given "app_label.ModelName", or None. """
+    for model in get_dynamic_models():
+        if "%s.%s" % (model._meta.app_label, model._meta.object_name) == name:
+            return model
+
+
+def prewarm(admin_site=None, admin_class=None, local_hash=lambda i: i._hash, names=()):
+    """ Builds every registered dynamic model (or those of the given registry
+        names), registers them in the given admin site and loads the URL conf,
+        all once. Content types and permissions are created for all of the
+        models together. Call this in the master process of a preforking 
+        server before workers are forked, so that they share the built 
+        classes (copy-on-write) instead of building their own.
+
+        The hashes of the built models are set in the shared cache where 
+        there is no hash (no entry, or invalidated by notify_model_change 
+        before building started), so that get_cached_model in the workers 
+        accepts the prebuilt classes. Invalidations made while building are
+        not overwritten, the workers regenerate those models.
+        The database connections are closed, so that they are not shared by
+        the forked workers.
+    """
+    from .admin import reregister_in_admin, reload_urlconf, create_dynamic_permissions
+
+    since = get_invalidation_count()
+    built = list(get_dynamic_models(*names))
+    if admin_site is not None:
+        create_dynamic_permissions(built)
+    for model in built:
+        _publish_hash(model, local_hash(model), since)
+        if admin_site is not None:
+            reregister_in_admin(admin_site, model, admin_class, reload_urls=False, create_permissions=False)
+
+    reload_urlconf()
+    # Populate the URL resolver now, rather than in each worker
+    get_resolver(None).reverse_dict
+
+    for c in connections.all():
+        c.close()
+
+    # Avoid the garbage collector touching (and copying) the shared objects
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    return built
+
+
+def _publish_hash(model, model_hash, since):
+    """ Sets the model's hash in the shared cache, if there is none or it was
+        invalidated before the invalidation numbered since.
+    """
+    CACHE_KEY = HASH_CACHE_TEMPLATE % (model._meta.app_label, model._meta.object_name)
+    count = get_invalidation_count()
+    value = cache.get(CACHE_KEY)
+    invalidation = get_invalidation(value)
+    if value is None:
+        cache.add(CACHE_KEY, model_hash)
+    elif invalidation is not None and invalidation <= since:
+        cache.set(CACHE_KEY, model_hash)
+        # The cache can't compare and set, so if the model was invalidated 
+        # again meanwhile, leave it to the workers to regenerate it
+        if get_invalidation_count() != count:
+            cache.delete(CACHE_KEY)
+
+
 def when_classes_prepared(app_name, dependencies, fn):
     """ Runs the given function as soon as the model dependencies are available.
         You can use this to build dyanmic model classes on startup instead of
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Placement of dynamic models (and their tables) on several databases.
+
+    A placement policy is a callable taking an app_label and object_name,
+    which returns the database alias for that model, or None if it has no
+    opinion (the default database is then used). Set DYMO_DATABASE_PLACEMENT
+    to a policy, or to the dotted path of one, and add DynamicModelRouter to
+    DATABASE_ROUTERS so that queries go to the same database as the DDL.
+
+    eg. DYMO_DATABASE_PLACEMENT = HashPlacement(['shard1', 'shard2'], app_labels=['survey'])
+        DATABASE_ROUTERS = ['dymo.routing.DynamicModelRouter']
+
+    A model's table is not moved when its placement changes, so a dynamic
+    model must keep its database when it is renamed. The table migration 
+    signals refuse to rename a model if the policy would place the new name
+    on another database, see check_rename(). Pin such models with a 
+    MappingPlacement in front of the policy, see ChainedPlacement.
+"""
+
+import zlib
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.importlib import import_module
+
+
+class HashPlacement(object):
+    """ Spreads models over the given aliases by a hash of their name.
+        Only models in the given app_labels are placed, if any are given.
+        NB the hash is of the model's name, so renaming a model (or adding 
+        an alias) changes its database, while its table is not moved.
+    """
+    def __init__(self, aliases, app_labels=None):
+        self.aliases = list(aliases)
+        self.app_labels = set(app_labels) if app_labels is not None else None
+
+    def __call__(self, app_label, object_name):
+        if self.app_labels is not None and app_label not in self.app_labels:
+            return None
+        key = ("%s.%s" % (app_label, object_name.lower())).encode('utf-8')
+        return self.aliases[(zlib.crc32(key) & 0xffffffff) % len(self.aliases)]
+
+
+class MappingPlacement(object):
+    """ Places models using a dictionary keyed on "app_label.ObjectName"
+        or "app_label", eg. the app_label each registry of dynamic models uses.
+    """
+    def __init__(self, mapping):
+        self.mapping = dict((k.lower(), v) for k, v in mapping.items())
+
+    def __call__(self, app_label, object_name):
+        key = "%s.%s" % (app_label, object_name)
+        return self.mapping.get(key.lower(), self.mapping.get(app_label.lower()))
+
+
+class ChainedPlacement(object):
+    """ Uses the first of the given policies that has an opinion, 
+        eg. ChainedPlacement(MappingPlacement(pins), HashPlacement(aliases))
+    """
+    def __init__(self, *placements):
+        self.placements = placements
+
+    def __call__(self, app_label, object_name):
+        for placement in self.placements:
+            alias = placement(app_label, object_name)
+            if alias is not None:
+                return alias
+        return None
+
+
+def _load_placement():
+    placement = getattr(settings, "DYMO_DATABASE_PLACEMENT", None)
+    if isinstance(placement, basestring):
+        module_name, name = placement.rsplit(".", 1)
+        placement = getattr(import_module(module_name), name)
+    return placement
+
+
+def _no_placement(app_label, object_name):
+    return None
+
+_placement = None
+
+def get_placement():
+    global _placement
+    if _placement is None:
+        _placement = _load_placement() or _no_placement
+    return _placement
+
+
+def set_placement(placement):
+    """ Sets the placement policy, None returns to the setting. """
+    global _placement
+    _placement = placement
+
+
+def get_database(app_label, object_name):
+    """ Returns the database alias for the given dynamic model. """
+    return get_placement()(app_label, object_name) or DEFAULT_DB_ALIAS
+
+
+def get_database_for_model(model):
+    return get_database(model._meta.app_label, model._meta.object_name)
+
+
+def has_placement():
+    " Returns True if a placement policy is in use. "
+    return get_placement() is not _no_placement
+
+
+def check_rename(app_label, old_object_name, new_object_name):
+    """ Raises ValueError if renaming the given dynamic model would place it 
+        on another database, where its table is not.
+    """
+    old_alias = get_database(app_label, old_object_name)
+    new_alias = get_database(app_label, new_object_name)
+    if old_alias != new_alias:
+        raise ValueError("Renaming %s.%s to %s would move it from the '%s' database to '%s', "
+                    "pin it to '%s' in the placement policy first" % (app_label, old_object_name,
+                    new_object_name, old_alias, new_alias, old_alias))
+
+
+class DynamicModelRouter(object):
+    """ Routes the models placed by the placement policy to their database. """
+
+    def _placed(self, model):
+        return get_placement()(model._meta.app_label, model._meta.object_name)
+
+    def db_for_read(self, model, **hints):
+        return self._placed(model)
+
+    def db_for_write(self, model, **hints):
+        return self._placed(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        db1 = self._placed(obj1.__class__)
+        db2 = self._placed(obj2.__class__)
+        if db1 is None and db2 is None:
+            return None
+        return (db1 or DEFAULT_DB_ALIAS) == (db2 or DEFAULT_DB_ALIAS)
+
+    def allow_syncdb(self, db, model):
+        placed = self._placed(model)
+        if placed is None:
+            return None
+        return db == placed
@@ -4,19 +4,30 @@
 """ Signal builders to catch renamed tables and columns.
 """
 
+import sys
+import logging
+import threading
+from contextlib import contextmanager
 from django.db.models.signals import pre_save, post_save, post_delete
-from django.db import transaction, connection
+from django.db import transaction, connections
 
-from .db import rename_db_column, rename_db_table, delete_db_table, delete_db_column
-from .db import get_deleted_tables, get_deleted_columns, DELETED_PREFIX
+from .db import rename_db_column, rename_db_columns, rename_db_table, rename_db_tables, delete_db_table, delete_db_column
+from .db import get_deleted_tables, get_deleted_columns, bulk_save, DELETED_PREFIX
 from south.db import db
 from .sync import notify_model_change
-from .models import DeletedColumn, DeletedTable
+from .models import DeletedColumn, DeletedTable, SchemaJob, QUEUE_SCHEMA_CHANGES
+from .jobs import enqueue
+from .routing import get_database, has_placement, check_rename, DEFAULT_DB_ALIAS
+
+logger = logging.getLogger('dymo')
 
 OLD_COLUMN_NAME_ATTR = "_dymo_old_column_name"
 OLD_TABLE_NAME_ATTR = "_dymo_old_table_name"
 OLD_MODEL_NAME_ATTR = "_dymo_old_model_name"
 
+# Changes collected by batch_schema_changes(), per thread
+_batch = threading.local()
+
 
 def connect_column_migration_signals(model_class, col_attr, get_model_name, get_table_name, app_label=None, soft_delete=True):
     """ Connects signals to perform migration when column name has been changed or the column has been deleted.
@@ -40,7 +51,7 @@ def connect_table_migration_signals(model_class, model_name_attr, table_name_att
     """ Connects signals to perform migration when table name has been changed or the table has been deleted.
         Optionally, a soft delete can be set, which only renames the table out of the way.
     """
-    _pre_save = build_table_pre_save(model_name_attr, table_name_attr)
+    _pre_save = build_table_pre_save(model_name_attr, table_name_attr, app_label=app_label)
     pre_save.connect(_pre_save, sender=model_class, weak=False)
 
     _post_save = build_table_post_save(model_name_attr, table_name_attr, app_label)
@@ -91,15 +102,28 @@ def build_column_post_save(col_attr, get_model_name, get_table_name, app_label=N
             Add any necessary columns.
         """
 
-        # NB note that renaming takes place before notification, so that the change is already in the database
-        if hasattr(instance, OLD_COLUMN_NAME_ATTR):
-            rename_db_column(get_table_name(instance), getattr(instance, OLD_COLUMN_NAME_ATTR), getattr(instance, col_attr))
-
         # Use of discover the relevant app_label
         if app_label:
             _app_label = app_label
         else:
             _app_label = instance.sender._meta.app_label
+        using = get_database(_app_label, get_model_name(instance))
+
+        if QUEUE_SCHEMA_CHANGES and hasattr(instance, OLD_COLUMN_NAME_ATTR):
+            # The worker notifies other processes, once the column is renamed
+            enqueue(SchemaJob.RENAME_COLUMN, get_table_name(instance), getattr(instance, OLD_COLUMN_NAME_ATTR),
+                        getattr(instance, col_attr), _app_label, get_model_name(instance), using=using)
+            return
+
+        if _is_batching():
+            if hasattr(instance, OLD_COLUMN_NAME_ATTR):
+                _queue_column_change(using, get_table_name(instance), getattr(instance, OLD_COLUMN_NAME_ATTR), getattr(instance, col_attr), instance, col_attr)
+            _batch.notifications.add((_app_label, get_model_name(instance)))
+            return
+
+        # NB note that renaming takes place before notification, so that the change is already in the database
+        if hasattr(instance, OLD_COLUMN_NAME_ATTR):
+            rename_db_column(get_table_name(instance), getattr(instance, OLD_COLUMN_NAME_ATTR), getattr(instance, col_attr), using)
 
         notify_model_change(app_label=_app_label, object_name=get_model_name(instance), invalidate_only=True)
 
@@ -117,11 +141,23 @@ def build_column_post_delete(col_attr, get_model_name, get_table_name, app_label
     def column_post_delete(sender, instance, **kwargs):
         table_name = get_table_name(instance)
         column_name = getattr(instance, col_attr)
-        max_index = _get_max_deleted_index(get_deleted_columns(table_name))
+        _app_label = app_label or sender._meta.app_label
+        using = get_database(_app_label, get_model_name(instance))
+
+        if QUEUE_SCHEMA_CHANGES:
+            enqueue(SchemaJob.DELETE_COLUMN, table_name, column_name,
+                        app_label=_app_label, object_name=get_model_name(instance), using=using)
+            return
+
+        if _is_batching():
+            _queue_column_change(using, table_name, column_name, None, instance)
+            return
+
+        max_index = _get_max_deleted_index(get_deleted_columns(table_name, using))
 
         # Rename column out of the way
         new_column_name = DELETED_PREFIX + str(max_index + 1)
-        rename_db_column(table_name, column_name, new_column_name)
+        rename_db_column(table_name, column_name, new_column_name, using)
 
         # Log this renaming, if this functionality is available
         if DeletedColumn:
@@ -135,11 +171,192 @@ def build_column_post_delete(col_attr, get_model_name, get_table_name, app_label
     return column_post_delete
 
 
-def build_table_pre_save(model_name_attr, table_name_attr=None, query=None):
+@contextmanager
+def batch_schema_changes():
+    """ Collects the column renames and the column and table soft deletes 
+        made by the migration signals in this block, and applies them when 
+        it exits: the database is introspected once per table (and once for 
+        all tables) and the changes to each table are made in a single
+        transaction. Deletion logs are written together, and model change 
+        notifications are sent once per model after the changes are made.
+
+        eg. with batch_schema_changes():
+                for attribute in attributes:
+                    attribute.delete()
+
+        If the block raises, only the changes whose definitions were 
+        committed (ie. are deleted or renamed in the database) are applied 
+        before the exception propagates: the deletes of a failed queryset
+        delete may have been rolled back, for example. Inside a managed
+        transaction (eg. commit_on_success) they are all discarded, as the
+        definitions are expected to be rolled back.
+    """
+    if _is_batching():
+        # Nested, the outermost block applies the changes
+        yield
+        return
+
+    _batch.tables = {}
+    _batch.deleted_tables = {}
+    _batch.notifications = set()
+    _batch.definitions = {}
+    try:
+        yield
+    except:
+        exc_info = sys.exc_info()
+        changes = _pop_batch()
+        definitions = changes.pop()
+        if not transaction.is_managed():
+            try:
+                _apply_batch(*_get_committed(definitions, *changes))
+            except Exception:
+                logger.exception("Could not apply the batched schema changes")
+        raise exc_info[0], exc_info[1], exc_info[2]
+    _apply_batch(*_pop_batch()[:-1])
+
+
+def _pop_batch():
+    changes = [_batch.tables, _batch.deleted_tables, _batch.notifications, _batch.definitions]
+    _batch.tables = None
+    _batch.deleted_tables = None
+    _batch.notifications = None
+    _batch.definitions = None
+    return changes
+
+
+def _add_definition(key, instance, attr=None):
+    """ Records the definition behind a batched change, so that it can be 
+        checked if the block fails. With attr, the change is a rename to 
+        the current value of attr, otherwise a delete.
+    """
+    value = getattr(instance, attr) if attr else None
+    _batch.definitions[key] = (instance.__class__, instance._state.db, instance.pk, attr, value)
+
+
+def _is_committed(definition):
+    " Whether the delete or rename of the given definition is in the database. "
+    model, using, pk, attr, value = definition
+    query = model._default_manager.db_manager(using).filter(pk=pk)
+    if attr is None:
+        return not query.exists()
+    return query.filter(**{attr: value}).exists()
+
+
+def _get_committed(definitions, tables, deleted_tables, notifications):
+    " Returns the batched changes, without those of definitions that weren't committed. "
+    committed = lambda key: key not in definitions or _is_committed(definitions[key])
+    committed_tables = {}
+    for using, using_tables in tables.items():
+        for table_name, changes in using_tables.items():
+            changes = [c for c in changes if committed(('column', using, table_name) + c)]
+            if changes:
+                committed_tables.setdefault(using, {})[table_name] = changes
+    committed_deleted_tables = {}
+    for using, table_names in deleted_tables.items():
+        table_names = [t for t in table_names if committed(('table', using, t))]
+        if table_names:
+            committed_deleted_tables[using] = table_names
+    return committed_tables, committed_deleted_tables, notifications
+
+
+def _apply_batch(tables, deleted_tables, notifications):
+    for using, using_tables in tables.items():
+        # Columns of deleted tables go with the table
+        for table_name in deleted_tables.get(using, ()):
+            using_tables.pop(table_name, None)
+        apply_column_changes(using_tables, using)
+    for using, table_names in deleted_tables.items():
+        soft_delete_tables(table_names, using)
+
+    for _app_label, model_name in notifications:
+        notify_model_change(app_label=_app_label, object_name=model_name, invalidate_only=True)
+
+
+def bulk_delete(queryset):
+    """ Deletes a queryset of table or column definitions, with the soft 
+        deletes made by the migration signals batched, see batch_schema_changes.
+    """
+    with batch_schema_changes():
+        queryset.delete()
+
+
+def _is_batching():
+    return getattr(_batch, 'tables', None) is not None
+
+
+def _queue_column_change(using, table_name, old_name, new_name, instance, col_attr=None):
+    " Queues a rename, or a soft delete if new_name is None. "
+    _batch.tables.setdefault(using, {}).setdefault(table_name, []).append((old_name, new_name))
+    _add_definition(('column', using, table_name, old_name, new_name), instance, col_attr)
+
+
+def apply_column_changes(tables, using=DEFAULT_DB_ALIAS):
+    """ Applies the given column changes {table_name: [(old_name, new_name)]},
+        where a new_name of None is a soft delete. Each table is introspected 
+        at most once and changed in a single transaction. Soft deletes are 
+        logged, if this functionality is available.
+    """
+    logs = []
+    for table_name, changes in tables.items():
+        max_index = None
+        renames = []
+        for old_name, new_name in changes:
+            if new_name is None:
+                if max_index is None:
+                    max_index = _get_max_deleted_index(get_deleted_columns(table_name, using))
+                max_index += 1
+                new_name = DELETED_PREFIX + str(max_index)
+                if DeletedColumn:
+                    logs.append(DeletedColumn(original_table_name=table_name,
+                                    original_name=old_name, current_name=new_name))
+            renames.append((old_name, new_name))
+        rename_db_columns(table_name, renames, using)
+
+    bulk_save(DeletedColumn, logs)
+
+
+def soft_delete_tables(table_names, using=DEFAULT_DB_ALIAS):
+    """ Renames the given tables out of the way, using a single introspection
+        and transaction. Tables that don't exist are only logged, as in 
+        the table_post_delete signal.
+    """
+    if not table_names:
+        return
+
+    connection = connections[using]
+    existing = set(connection.introspection.table_names())
+    max_index = _get_max_deleted_index(t for t in existing if t.startswith(DELETED_PREFIX))
+    renames = []
+    logs = []
+    for table_name in table_names:
+        if connection.introspection.table_name_converter(table_name) in existing:
+            max_index += 1
+            new_table_name = DELETED_PREFIX + str(max_index)
+            renames.append((table_name, new_table_name))
+        else:
+            new_table_name = ''
+        if DeletedTable:
+            logs.append(DeletedTable(original_name=table_name, current_name=new_table_name))
+
+    rename_db_tables(renames, using)
+    bulk_save(DeletedTable, logs)
+
+
+def build_table_pre_save(model_name_attr, table_name_attr=None, query=None, app_label=None):
     """ If table_name_attr is given, identify when a table name changes. 
+        With a placement policy (see dymo.routing), renames that would move
+        the model to another database are refused.
     """
 
     def table_pre_save(sender, instance, **kwargs):
+        if instance.pk and has_placement():
+            try:
+                old_model_name = sender.objects.filter(pk=instance.pk).values_list(model_name_attr, flat=True)[0]
+            except IndexError:
+                pass
+            else:
+                check_rename(app_label or sender._meta.app_label, old_model_name, getattr(instance, model_name_attr))
+
         if table_name_attr:
             if query is not None:
                 _query = query
@@ -167,13 +384,6 @@ def build_table_post_save(model_name_attr, table_name_attr=None, app_label=None)
         """  Rename any tables and notify other processes of a potential model change.
         """
     
-        # If table name changes are to be tracked, rename the database table
-        if table_name_attr and hasattr(instance, OLD_TABLE_NAME_ATTR):
-            old_name = getattr(instance, OLD_TABLE_NAME_ATTR)
-            new_name = getattr(instance, table_name_attr)
-            rename_db_table(old_name, new_name)
-            delattr(instance, OLD_TABLE_NAME_ATTR)
-
         # Invalidate any old definitions 
         if hasattr(instance, OLD_MODEL_NAME_ATTR):
             model_name = getattr(instance, OLD_MODEL_NAME_ATTR)
@@ -186,6 +396,18 @@ def build_table_post_save(model_name_attr, table_name_attr=None, app_label=None)
         else:
             _app_label = sender._meta.app_label
 
+        # If table name changes are to be tracked, rename the database table
+        if table_name_attr and hasattr(instance, OLD_TABLE_NAME_ATTR):
+            old_name = getattr(instance, OLD_TABLE_NAME_ATTR)
+            new_name = getattr(instance, table_name_attr)
+            delattr(instance, OLD_TABLE_NAME_ATTR)
+            using = get_database(_app_label, model_name)
+            if QUEUE_SCHEMA_CHANGES:
+                # The worker notifies other processes, once the table is renamed
+                enqueue(SchemaJob.RENAME_TABLE, new_name, old_name, new_name, _app_label, model_name, using=using)
+                return
+            rename_db_table(old_name, new_name, using)
+
         notify_model_change(app_label=_app_label, object_name=model_name, invalidate_only=True)
 
     return table_post_save
@@ -196,14 +418,26 @@ def build_table_post_delete(model_name_attr, table_name_attr=None, app_label=Non
     def table_post_delete(sender, instance, **kwargs):
         if table_name_attr:
             table_name = getattr(instance, table_name_attr)
-            max_index = _get_max_deleted_index(get_deleted_tables())
+            using = get_database(app_label or sender._meta.app_label, getattr(instance, model_name_attr))
+
+            if QUEUE_SCHEMA_CHANGES:
+                enqueue(SchemaJob.DELETE_TABLE, table_name, using=using)
+                return
+
+            if _is_batching():
+                _batch.deleted_tables.setdefault(using, []).append(table_name)
+                _add_definition(('table', using, table_name), instance)
+                return
+
+            max_index = _get_max_deleted_index(get_deleted_tables(using))
 
             # If table exists, rename it out of the way
             # XXX Race condition: if this table is created elsewhere
+            connection = connections[using]
             if (connection.introspection.table_name_converter(table_name) 
                         in connection.introspection.table_names()):
                 new_table_name = DELETED_PREFIX + str(max_index + 1)
-                rename_db_table(table_name, new_table_name)
+                rename_db_table(table_name, new_table_name, using)
             else:
                 new_table_name = ''
 
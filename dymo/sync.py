@@ -1,17 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import time
 import logging
-from django.db import models
+import threading
+from django.db import models, connections
+from django.conf import settings
 from django.core.cache import cache
 from django.db.models.loading import cache as app_cache
 
+from .fields import clear_m2m_attr_cache
+from . import metrics
+
 logger = logging.getLogger('dymo')
 
+# While a model is being regenerated, other threads may keep using the 
+# previous class for this many seconds, instead of waiting.
+REGENERATION_GRACE_PERIOD = getattr(settings, "DYMO_REGENERATION_GRACE_PERIOD", 0)
+# Also allow only one process to regenerate a model at a time, using the cache
+REGENERATION_CROSS_PROCESS = getattr(settings, "DYMO_REGENERATION_CROSS_PROCESS", False)
+REGENERATION_LOCK_TIMEOUT = getattr(settings, "DYMO_REGENERATION_LOCK_TIMEOUT", 30)
+# Return out of date classes while they are regenerated in a background thread
+REGENERATE_IN_BACKGROUND = getattr(settings, "DYMO_REGENERATE_IN_BACKGROUND", False)
+
 
 def get_cached_model(app_label, model_name, regenerate=False, local_hash=lambda i: i._hash):
     """ Return the locally cached model (from Django's model cache). 
         Returns None if there is no cached model, or if it is out of date.
+        While another thread regenerates the model with 
+        get_or_regenerate_model, the class it returns is given instead.
     """
 
     # If this model has already been generated, we'll find it here
@@ -23,17 +40,184 @@ def get_cached_model(app_label, model_name, regenerate=False, local_hash=lambda
         if cache.get(CACHE_KEY) != local_hash(previous_model):
             logging.debug("Local and shared dynamic model hashes are different: %s (local) %s (shared)" % (local_hash(previous_model), cache.get(CACHE_KEY)))
             regenerate = True
+
+    # Don't rebuild a model another thread is regenerating
+    if previous_model is None or regenerate:
+        regeneration = _regenerations.get((app_label, model_name.lower()))
+        if regeneration is not None and regeneration.thread is not threading.current_thread():
+            return _get_regenerating_model(regeneration)
         
     # We can force regeneration by disregarding the previous model
     if regenerate:
+        metrics.incr('dymo.get_cached_model.regenerate')
         previous_model = None
         # Django keeps a cache of registered models, we need to make room for
         # our new one
         remove_from_model_cache(app_label, model_name)
+    elif previous_model is None:
+        metrics.incr('dymo.get_cached_model.miss')
+    else:
+        metrics.incr('dymo.get_cached_model.hit')
 
     return previous_model
 
 
+class _Regeneration(object):
+    " A model regeneration in progress, shared by the threads that need it. "
+    def __init__(self, previous_model=None, background=False):
+        self.started = time.time()
+        self.done = threading.Event()
+        self.previous_model = previous_model
+        self.background = background
+        self.model = None
+        # The thread running build_fn()
+        self.thread = None
+
+_regenerations = {}
+_regenerations_lock = threading.Lock()
+
+
+def get_or_regenerate_model(app_label, model_name, build_fn, local_hash=lambda i: i._hash,
+            grace_period=REGENERATION_GRACE_PERIOD, cross_process=REGENERATION_CROSS_PROCESS,
+            background=REGENERATE_IN_BACKGROUND):
+    """ Returns the current model, calling build_fn() to build it if the 
+        locally cached model is missing or out of date.
+
+        Only one thread regenerates a given model at a time, the others wait
+        for its result. If they have the previous class, they return that 
+        instead, until the regeneration has taken longer than grace_period.
+        With cross_process, a lock is taken in the shared cache and processes 
+        that have a previous class will return it while another process
+        regenerates.
+
+        With background, an out of date class is returned straight away
+        (stale-while-revalidate) while a background thread builds the new 
+        one, which is returned once it is ready. The previous class may not 
+        match the database schema, so it should only be used for reading.
+
+        NB Django won't build a model class while one of the same name is 
+        in its model cache, so the previous class is removed from it for 
+        the duration of build_fn(). Other threads calling 
+        get_or_regenerate_model or get_cached_model are given the previous
+        class (or wait for the new one) meanwhile, but models.get_model(),
+        lazy relations and the admin will find no model. If build_fn() 
+        fails, the previous class is put back.
+    """
+    previous_model = models.get_model(app_label, model_name)
+    if previous_model is not None:
+        CACHE_KEY = HASH_CACHE_TEMPLATE % (app_label, model_name)
+        if cache.get(CACHE_KEY) == local_hash(previous_model):
+            metrics.incr('dymo.get_cached_model.hit')
+            return previous_model
+
+    key = (app_label, model_name.lower())
+    background = background and previous_model is not None
+    with _regenerations_lock:
+        regeneration = _regenerations.get(key)
+        leader = regeneration is None
+        if leader:
+            regeneration = _regenerations[key] = _Regeneration(previous_model, background)
+
+    if not leader:
+        model = _get_regenerating_model(regeneration, grace_period)
+        if model is None:
+            # The regeneration failed, try again (and raise the error here)
+            return get_or_regenerate_model(app_label, model_name, build_fn, local_hash, grace_period, cross_process, background)
+        return model
+
+    # A previous leader may have finished since the model was looked up
+    current_model = models.get_model(app_label, model_name)
+    if current_model is not None:
+        if cache.get(HASH_CACHE_TEMPLATE % (app_label, model_name)) == local_hash(current_model):
+            regeneration.model = current_model
+            with _regenerations_lock:
+                del _regenerations[key]
+            regeneration.done.set()
+            metrics.incr('dymo.get_cached_model.hit')
+            return current_model
+
+    if background:
+        thread = threading.Thread(target=_regenerate_in_background,
+                        args=(key, regeneration, build_fn, cross_process))
+        thread.daemon = True
+        thread.start()
+        metrics.incr('dymo.get_cached_model.stale')
+        return previous_model
+
+    return _regenerate(key, regeneration, build_fn, cross_process)
+
+
+def _get_regenerating_model(regeneration, grace_period=REGENERATION_GRACE_PERIOD):
+    """ Returns the previous class while the given regeneration is in the
+        background or within the grace period, otherwise waits for the new 
+        one. Returns None if the regeneration failed.
+    """
+    # The previous class is no longer in Django's model cache once the 
+    # regeneration has started, so it is kept here
+    if regeneration.previous_model is not None and (regeneration.background 
+                        or time.time() - regeneration.started < grace_period):
+        metrics.incr('dymo.get_cached_model.stale')
+        return regeneration.previous_model
+    metrics.incr('dymo.get_cached_model.wait')
+    regeneration.done.wait()
+    return regeneration.model
+
+
+def _regenerate(key, regeneration, build_fn, cross_process):
+    " Builds the model as the leader of the given regeneration. "
+    app_label, model_name = key
+    regeneration.thread = threading.current_thread()
+    LOCK_KEY = REGENERATION_LOCK_TEMPLATE % key
+    locked = False
+    try:
+        if cross_process:
+            locked = cache.add(LOCK_KEY, True, REGENERATION_LOCK_TIMEOUT)
+            if not locked and regeneration.previous_model is not None:
+                # Another process is regenerating, keep using what we have
+                metrics.incr('dymo.get_cached_model.stale')
+                regeneration.model = regeneration.previous_model
+                return regeneration.model
+
+        metrics.incr('dymo.get_cached_model.regenerate')
+        # Django keeps a cache of registered models, we need to make room for
+        # our new one
+        remove_from_model_cache(app_label, model_name)
+        try:
+            regeneration.model = build_fn()
+        except Exception:
+            if regeneration.previous_model is not None and models.get_model(app_label, model_name) is None:
+                _restore_model(regeneration.previous_model)
+            raise
+        return regeneration.model
+
+    finally:
+        if locked:
+            cache.delete(LOCK_KEY)
+        with _regenerations_lock:
+            del _regenerations[key]
+        regeneration.done.set()
+
+
+def _regenerate_in_background(key, regeneration, build_fn, cross_process):
+    try:
+        _regenerate(key, regeneration, build_fn, cross_process)
+    except Exception:
+        logger.exception("Could not regenerate dynamic model %s.%s" % key)
+    finally:
+        # Django opens database connections per thread
+        for c in connections.all():
+            c.close()
+
+
+def _restore_model(model):
+    " Puts a model removed by remove_from_model_cache back in the model cache. "
+    app_cache.register_models(model._meta.app_label, model)
+    for f in model._meta.local_many_to_many:
+        through = f.rel.through
+        if through is not None and not isinstance(through, basestring) and through._meta.auto_created:
+            app_cache.register_models(through._meta.app_label, through)
+
+
 def remove_from_model_cache(app_label, model_name):
     """ Removes the given model from the model cache. """
 
@@ -48,6 +232,12 @@ def remove_from_model_cache(app_label, model_name):
                 del f.rel.to._meta._related_many_to_many_cache
             except AttributeError:
                 pass
+        # Auto-created through models would otherwise be reused by the
+        # next class, with their relations to this one
+        for f in model._meta.local_many_to_many:
+            through = f.rel.through
+            if through is not None and not isinstance(through, basestring) and through._meta.auto_created:
+                app_cache.app_models.get(through._meta.app_label, {}).pop(through._meta.object_name.lower(), None)
 
     # Delete from the central model cache
     try:
@@ -55,6 +245,9 @@ def remove_from_model_cache(app_label, model_name):
     except KeyError:
         pass
 
+    # Forget m2m columns resolved for the old class
+    clear_m2m_attr_cache(app_label, model_name)
+
 
 def notify_model_change(model=None, app_label=None, object_name=None, invalidate_only=False, local_hash=lambda i: i._hash):
     """ Notifies other processes that a dynamic model has changed. 
@@ -64,8 +257,10 @@ def notify_model_change(model=None, app_label=None, object_name=None, invalidate
         app_label = model._meta.app_label
         object_name = model._meta.object_name
     CACHE_KEY = HASH_CACHE_TEMPLATE % (app_label, object_name) 
+    metrics.incr('dymo.notify_model_change')
     if invalidate_only:
-        val = None
+        # Numbered, so that prewarm() can tell when it happened
+        val = (INVALIDATED, _count_invalidation())
         #dynamic_model_changed.send(sender=None, app_label=app_label, object_name=object_name)
     elif model:
         val = local_hash(model)
@@ -73,9 +268,34 @@ def notify_model_change(model=None, app_label=None, object_name=None, invalidate
 
     cache.set(CACHE_KEY, val)
 
+
+def _count_invalidation():
+    " Returns the next number from the shared invalidation counter. "
+    try:
+        return cache.incr(INVALIDATION_COUNTER_KEY)
+    except ValueError:
+        cache.add(INVALIDATION_COUNTER_KEY, 0)
+        return cache.incr(INVALIDATION_COUNTER_KEY)
+
+
+def get_invalidation_count():
+    " Returns the number of the last invalidation made by notify_model_change. "
+    return cache.get(INVALIDATION_COUNTER_KEY) or 0
+
+
+def get_invalidation(value):
+    """ Returns the number of the invalidation for a value of the hash cache, 
+        or None if it isn't one.
+    """
+    if isinstance(value, tuple) and len(value) == 2 and value[0] == INVALIDATED:
+        return value[1]
+
 import django.dispatch
 dynamic_model_changed = django.dispatch.Signal(providing_args=["sender", "app_label", "object_name"])
 
 
 HASH_CACHE_TEMPLATE = 'dynamic_model_hash_%s-%s'
+REGENERATION_LOCK_TEMPLATE = 'dynamic_model_lock_%s-%s'
+INVALIDATION_COUNTER_KEY = 'dynamic_model_invalidations'
+INVALIDATED = 'invalidated'
 
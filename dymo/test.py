@@ -3,14 +3,15 @@
 
 from django.test import TestCase as DjangoTestCase
 from django.core.management import call_command
-from django.db import connection, transaction, models
+from django.db import connection, connections, transaction, models
 from django.contrib.contenttypes.models import ContentType 
 from django.contrib.auth.models import Permission 
 from django.core.management.color import no_style
 from django.core.management.sql import sql_flush
-from south.db import db
+from south.db import dbs
 
 from .registry import get_dynamic_models
+from .routing import get_database_for_model
 
 class TestCase(DjangoTestCase):
 
@@ -48,42 +49,54 @@ class TestCase(DjangoTestCase):
                 all(get_dynamic_models())
 
 
-def delete_dynamic_tables(*names):
-    db.start_transaction()
-    for model in get_dynamic_models(*names):
-        for f in model._meta.fields:
-            if isinstance(f, models.ForeignKey):
-                try:
-                    db.delete_foreign_key(model._meta.db_table, f.column)
-                except ValueError:
-                    pass
-    transaction.commit_unless_managed()
-
-    db.start_transaction()
+def _get_dynamic_models_by_database(*names):
+    " Returns {alias: [models]} for the dynamic models, see dymo.routing "
+    by_database = {}
     for model in get_dynamic_models(*names):
-        db.delete_table(model._meta.db_table, cascade=True)
-    #db.commit_transaction()
-    transaction.commit_unless_managed()
+        by_database.setdefault(get_database_for_model(model), []).append(model)
+    return by_database
+
+
+def delete_dynamic_tables(*names):
+    for using, dynamic_models in _get_dynamic_models_by_database(*names).items():
+        db = dbs[using]
+        db.start_transaction()
+        for model in dynamic_models:
+            for f in model._meta.fields:
+                if isinstance(f, models.ForeignKey):
+                    try:
+                        db.delete_foreign_key(model._meta.db_table, f.column)
+                    except ValueError:
+                        pass
+        transaction.commit_unless_managed(using=using)
+
+        db.start_transaction()
+        for model in dynamic_models:
+            db.delete_table(model._meta.db_table, cascade=True)
+        #db.commit_transaction()
+        transaction.commit_unless_managed(using=using)
 
 def flush_dynamic_tables(*names):
-    db.start_transaction()
-    tables = [] #connection.introspection.django_table_names(only_existing=True)
-    for model in get_dynamic_models(*names):
-        #for f in model._meta.fields:
-        #    if isinstance(f, models.ForeignKey):
-        #        db.delete_foreign_key(model._meta.db_table, f.db_column)
-        tables.append(model._meta.db_table)
-
-    statements = connection.ops.sql_flush(
-        no_style(), tables, connection.introspection.sequence_list()
-    )
-
-    try:
-        cursor = connection.cursor()
-        for sql in statements:
-            cursor.execute(sql)
-    except Exception, e:
-        transaction.rollback_unless_managed()#using=db)
-        raise
-    transaction.commit_unless_managed()#using=db)
+    for using, dynamic_models in _get_dynamic_models_by_database(*names).items():
+        dbs[using].start_transaction()
+        connection = connections[using]
+        tables = [] #connection.introspection.django_table_names(only_existing=True)
+        for model in dynamic_models:
+            #for f in model._meta.fields:
+            #    if isinstance(f, models.ForeignKey):
+            #        db.delete_foreign_key(model._meta.db_table, f.db_column)
+            tables.append(model._meta.db_table)
+
+        statements = connection.ops.sql_flush(
+            no_style(), tables, connection.introspection.sequence_list()
+        )
+
+        try:
+            cursor = connection.cursor()
+            for sql in statements:
+                cursor.execute(sql)
+        except Exception, e:
+            transaction.rollback_unless_managed(using=using)
+            raise
+        transaction.commit_unless_managed(using=using)
 
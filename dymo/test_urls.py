@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# The URL conf for dymo.tests, reloaded by prewarm()
+from django.conf.urls.defaults import patterns
+
+urlpatterns = patterns('')
@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import csv
+import time
+import shutil
+import tempfile
+import threading
+from cStringIO import StringIO
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+from django.db import models, connection, connections, router, transaction
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+from django.db.utils import DatabaseError
+from django.contrib.admin.sites import AdminSite
+from django.core.urlresolvers import RegexURLResolver, Resolver404
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+
+from django.core.exceptions import ValidationError
+from .validation import shorten_identifier, build_identifier_index, validate_identifier_slug, validate_identifier_slugs
+from .validation import slug_to_identifier, slugs_to_identifiers, slug_to_class_name
+from .fields import ManyToManyField, clear_m2m_attr_cache
+from .sync import get_cached_model, get_or_regenerate_model, remove_from_model_cache, notify_model_change, HASH_CACHE_TEMPLATE
+from .warmstart import describe_model
+from .registry import prewarm, _dynamic_model_registry
+from .export import export_csv, export_json_lines, export_models
+from .load import load_rows, read_csv, read_json_lines, RejectWriter
+from .models import SchemaJob, DeletedTable, DeletedColumn, QUEUE_SCHEMA_CHANGES
+from .jobs import enqueue, run_pending_jobs, get_job_status, get_pending_jobs, retry_failed_jobs, recover_running_jobs
+from .db import create_db_table, add_necessary_db_columns, sync_db_indexes, _get_indexes, INDEX_DROPPED, UNIQUE_CREATED, UNIQUE_FAILED
+from .admin import reregister_in_admin, unregister_from_admin, admin_urls, create_dynamic_permissions
+from .routing import HashPlacement, MappingPlacement, ChainedPlacement, DynamicModelRouter, set_placement
+from .signals import connect_table_migration_signals, connect_column_migration_signals, batch_schema_changes, bulk_delete
+from .signals import build_column_post_delete
+from . import signals, db as db_module
+
+
+def build_model(class_name, app_label='dymo', **attrs):
+    " Builds a model class for the tests. "
+    attrs['__module__'] = 'dymo.tests'
+    attrs['Meta'] = type('Meta', (object,), {'app_label': app_label})
+    return type(class_name, (models.Model,), attrs)
+
+
+class ShortenIdentifierTest(TestCase):
+
+    def test_round_trip(self):
+        " The shortened name of an existing table is found again, not salted. "
+        long_name = "survey_" + "x" * 80
+        short_name = shorten_identifier(long_name, 63)
+        self.assertEqual(len(short_name), 63)
+
+        index = build_identifier_index(["survey_other", long_name], 63)
+        self.assertEqual(shorten_identifier(long_name, 63, index), short_name)
+        self.assertEqual(index[short_name], long_name)
+
+    def test_name_equal_to_short_form_is_a_collision(self):
+        long_name = "survey_" + "x" * 80
+        short_name = shorten_identifier(long_name, 63)
+        index = build_identifier_index([short_name], 63)
+        self.assertNotEqual(shorten_identifier(long_name, 63, index), short_name)
+
+    def test_collision_is_salted(self):
+        long_name = "survey_" + "x" * 80
+        short_name = shorten_identifier(long_name, 63)
+        index = {short_name: "survey_" + "x" * 90}
+        other_name = shorten_identifier(long_name, 63, index)
+        self.assertNotEqual(other_name, short_name)
+        self.assertEqual(len(other_name), 63)
+
+
+class IdentifierSlugTest(TestCase):
+
+    slugs = [u'colour', u'Colour-Code', u'colour--code', u'-colour-', u'2-colour', u'colour_code',
+             u'colour code', u'colour\n', u'\ncolour', u'col\xf6ur', u'', u'_noconflict_x', u'-noconflict-x']
+
+    def old_slug_error(self, val):
+        " The checks made before the patterns were precompiled. "
+        try:
+            val.encode("ascii")
+        except UnicodeEncodeError:
+            return True
+        for char in val:
+            if not char.isalnum() and char not in "-":
+                return True
+        return val[:1].isdigit() or val.startswith(("_noconflict_", "-noconflict-"))
+
+    def old_slug_to_identifier(self, val):
+        val = val.encode('ascii', 'ignore').replace("-","_").lower()
+        val = filter(lambda x: x.isalnum() or x in "_", val)
+        while "__" in val:
+            val = val.replace("__", "_")
+        return val.lstrip("0123456789_")
+
+    def test_matches_old_conversion(self):
+        for val in self.slugs:
+            self.assertEqual(slug_to_identifier(val), self.old_slug_to_identifier(val))
+            old_class_name = filter(lambda s: s.isalnum(), val.encode('ascii', 'ignore').title()).lstrip("0123456789")
+            self.assertEqual(slug_to_class_name(val), old_class_name)
+        self.assertEqual(slugs_to_identifiers(self.slugs), [self.old_slug_to_identifier(val) for val in self.slugs])
+
+    def test_matches_old_validation(self):
+        for val in self.slugs:
+            self.assertEqual(bool(validate_identifier_slugs([val])), self.old_slug_error(val), val)
+
+    def test_trailing_newline_is_rejected(self):
+        self.assertRaises(ValidationError, validate_identifier_slug, u'colour\n')
+        self.assertTrue(u'colour\n' in validate_identifier_slugs([u'colour\n']))
+
+    def test_collisions_after_normalisation(self):
+        errors = validate_identifier_slugs([u'Colour-Code', u'colour', u'colour--code', u'colour-code'])
+        self.assertEqual(sorted(errors), [u'colour--code', u'colour-code'])
+        self.assertEqual(errors[u'colour-code'], [u'Colour-Code and colour-code both become colour_code.'])
+        self.assertEqual(validate_identifier_slugs([u'a-b', u'A-B'], normalise=lambda val: val), {})
+
+
+TestColour = build_model('TestColour', name=models.CharField(max_length=10))
+TestColour._hash = 'colour-1'
+TestPaint = build_model('TestPaint', colour=models.ForeignKey(TestColour), code=models.CharField(max_length=5))
+TestDefinition = build_model('TestDefinition', name=models.CharField(max_length=50),
+                            table=models.CharField(max_length=50))
+connect_table_migration_signals(TestDefinition, 'name', 'table')
+TestAttribute = build_model('TestAttribute', table=models.CharField(max_length=50),
+                            column=models.CharField(max_length=50))
+connect_column_migration_signals(TestAttribute, 'column', lambda i: 'TestBatched', lambda i: i.table, app_label='dymo')
+TestCar = build_model('TestCar', colours=ManyToManyField(TestColour))
+
+
+class ManyToManyFieldTest(TestCase):
+
+    def setUp(self):
+        clear_m2m_attr_cache('dymo', 'TestCar')
+        self.field = TestCar._meta.get_field('colours')
+
+    def test_curried_attributes(self):
+        through_fields = dict((f.rel.to, f) for f in self.field.rel.through._meta.fields if f.rel)
+        for related_model in (TestCar, TestColour):
+            related = type('Related', (object,), {'model': related_model})
+            through_field = through_fields[related_model]
+            for attr in ('name', 'column', 'rel'):
+                self.assertEqual(self.field._get_m2m_attr(related, attr), getattr(through_field, attr))
+
+    def test_m2m_column_names(self):
+        self.assertEqual(self.field.m2m_column_name(), 'testcar_id')
+        self.assertEqual(self.field.m2m_reverse_name(), 'testcolour_id')
+
+    def test_each_generation_resolves_its_own_through_model(self):
+        related = type('Related', (object,), {'model': TestColour})
+        old_field = build_model('TestVan', colours=ManyToManyField(TestColour))._meta.get_field('colours')
+        remove_from_model_cache('dymo', 'TestVan')
+        new_field = build_model('TestVan', colours=ManyToManyField(TestColour))._meta.get_field('colours')
+        try:
+            # The old class is still served while the new one is built
+            for field in (old_field, new_field, old_field):
+                through_field = [f for f in field.rel.through._meta.fields if f.rel and f.rel.to is TestColour][0]
+                self.assertTrue(field._get_m2m_attr(related, 'rel') is through_field.rel)
+        finally:
+            remove_from_model_cache('dymo', 'TestVan')
+
+
+class RegenerationTest(TestCase):
+
+    def setUp(self):
+        self.model = build_model('TestRegenerated', name=models.CharField(max_length=10))
+        self.model._hash = 1
+        cache.set(HASH_CACHE_TEMPLATE % ('dymo', 'TestRegenerated'), 2)
+
+    def tearDown(self):
+        remove_from_model_cache('dymo', 'TestRegenerated')
+
+    def test_failed_build_keeps_previous_model(self):
+        def build_fn():
+            raise ValueError("Bad definition")
+        self.assertRaises(ValueError, get_or_regenerate_model, 'dymo', 'TestRegenerated', build_fn)
+        self.assertTrue(models.get_model('dymo', 'TestRegenerated') is self.model)
+
+    def test_regenerate(self):
+        def build_fn():
+            model = build_model('TestRegenerated', name=models.CharField(max_length=10))
+            model._hash = 2
+            return model
+        model = get_or_regenerate_model('dymo', 'TestRegenerated', build_fn)
+        self.assertEqual(model._hash, 2)
+        self.assertTrue(models.get_model('dymo', 'TestRegenerated') is model)
+
+    def test_model_regenerated_meanwhile_is_not_rebuilt(self):
+        new_models = []
+        def local_hash(model):
+            if model is self.model and not new_models:
+                # Another thread finishes regenerating the model after it
+                # was looked up
+                remove_from_model_cache('dymo', 'TestRegenerated')
+                new_models.append(build_model('TestRegenerated', name=models.CharField(max_length=10)))
+                new_models[0]._hash = 2
+            return model._hash
+        def build_fn():
+            raise AssertionError("Regenerated twice")
+        model = get_or_regenerate_model('dymo', 'TestRegenerated', build_fn, local_hash=local_hash)
+        self.assertTrue(model is new_models[0])
+
+    def test_cached_model_during_background_regeneration(self):
+        building, release = threading.Event(), threading.Event()
+        seen_by_builder = []
+        def build_fn():
+            seen_by_builder.append(get_cached_model('dymo', 'TestRegenerated'))
+            building.set()
+            release.wait()
+            model = build_model('TestRegenerated', name=models.CharField(max_length=10))
+            model._hash = 2
+            return model
+        self.assertTrue(get_or_regenerate_model('dymo', 'TestRegenerated', build_fn, background=True) is self.model)
+        building.wait()
+        try:
+            self.assertTrue(models.get_model('dymo', 'TestRegenerated') is None)
+            self.assertTrue(get_cached_model('dymo', 'TestRegenerated') is self.model)
+        finally:
+            release.set()
+        for __ in range(100):
+            model = models.get_model('dymo', 'TestRegenerated')
+            if model is not None and model._hash == 2:
+                break
+            time.sleep(0.05)
+        self.assertTrue(get_cached_model('dymo', 'TestRegenerated') is model)
+        # The regenerating thread itself is told to build the model
+        self.assertEqual(seen_by_builder, [None])
+
+
+class WarmStartTest(TestCase):
+
+    def test_describe_m2m_field(self):
+        description = describe_model(TestCar, local_hash=lambda m: 1)
+        fields = dict((f[0], f[1:]) for f in description['fields'])
+        self.assertEqual(fields['colours'][0], 'dymo.fields.ManyToManyField')
+
+    def test_describe_unknown_field(self):
+        class UnknownField(models.IntegerField):
+            pass
+        model = build_model('TestUnknownField', size=UnknownField())
+        try:
+            self.assertRaises(ValueError, describe_model, model, lambda m: 1)
+        finally:
+            remove_from_model_cache('dymo', 'TestUnknownField')
+
+
+class PrewarmTest(TestCase):
+    urls = 'dymo.test_urls'
+
+    def setUp(self):
+        _dynamic_model_registry['dymo_tests'] = lambda: [TestColour]
+        self.cache_key = HASH_CACHE_TEMPLATE % ('dymo', 'TestColour')
+        cache.delete(self.cache_key)
+
+    def tearDown(self):
+        del _dynamic_model_registry['dymo_tests']
+        cache.delete(self.cache_key)
+
+    def test_publishes_hash(self):
+        self.assertEqual(prewarm(names=['dymo_tests']), [TestColour])
+        self.assertEqual(cache.get(self.cache_key), TestColour._hash)
+
+    def test_publishes_hash_after_invalidation(self):
+        notify_model_change(app_label='dymo', object_name='TestColour', invalidate_only=True)
+        prewarm(names=['dymo_tests'])
+        self.assertEqual(cache.get(self.cache_key), TestColour._hash)
+
+    def test_keeps_newer_hash(self):
+        cache.set(self.cache_key, 'colour-2')
+        prewarm(names=['dymo_tests'])
+        self.assertEqual(cache.get(self.cache_key), 'colour-2')
+
+    def test_keeps_invalidation_made_while_building(self):
+        def get_models():
+            notify_model_change(app_label='dymo', object_name='TestColour', invalidate_only=True)
+            return [TestColour]
+        _dynamic_model_registry['dymo_tests'] = get_models
+        prewarm(names=['dymo_tests'])
+        self.assertNotEqual(cache.get(self.cache_key), TestColour._hash)
+
+
+class LoadTest(TestCase):
+
+    def setUp(self):
+        self.red = TestColour.objects.create(name="red")
+        self.rejected = []
+
+    def reject(self, row, messages):
+        self.rejected.append((row, messages))
+
+    def test_foreign_keys_checked_per_batch(self):
+        rows = [{'colour': self.red.pk, 'code': 'r%d' % i} for i in range(10)]
+        rows.append({'colour': self.red.pk + 100, 'code': 'x'})
+        # One query for the related keys, one for the insert
+        with self.assertNumQueries(2):
+            loaded, rejected = load_rows(TestPaint, rows, batch_size=100, rejects=self.reject)
+        self.assertEqual((loaded, rejected), (10, 1))
+        self.assertEqual(self.rejected[0][0]['code'], 'x')
+        self.assertEqual(TestPaint.objects.count(), 10)
+
+    def test_malformed_json_is_rejected(self):
+        f = StringIO('{"colour": %d, "code": "a"}\n{"colour": \n[1]\n' % self.red.pk)
+        loaded, rejected = load_rows(TestPaint, read_json_lines(f), rejects=self.reject)
+        self.assertEqual((loaded, rejected), (1, 2))
+        self.assertEqual(self.rejected[0][0]['_line'], '{"colour":')
+
+    def test_csv_foreign_keys(self):
+        f = StringIO('colour,code\n%d,a\n%d,b\nred,c\n' % (self.red.pk, self.red.pk + 100))
+        loaded, rejected = load_rows(TestPaint, read_csv(f), rejects=self.reject)
+        self.assertEqual((loaded, rejected), (1, 2))
+        self.assertEqual(TestPaint.objects.get().colour, self.red)
+        self.assertEqual(sorted(row['code'] for row, messages in self.rejected), ['b', 'c'])
+
+    def test_reject_writer_columns(self):
+        out = StringIO()
+        rows = read_json_lines(StringIO('{"colour": \n{"colour_id": %d, "code": "toolong"}\n' % self.red.pk))
+        load_rows(TestPaint, rows, rejects=RejectWriter(out, TestPaint))
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,colour,code,_line,_errors')
+        self.assertTrue(lines[2].startswith(',%d,toolong,,code: ' % self.red.pk))
+
+
+class ExportTest(TransactionTestCase):
+
+    def create_paints(self, count):
+        red = TestColour.objects.create(name="red")
+        return [TestPaint.objects.create(colour=red, code='p%d' % i).pk for i in range(count)]
+
+    def test_csv_across_chunks(self):
+        pks = self.create_paints(5)
+        rows = list(csv.reader(''.join(export_csv(TestPaint, chunk_size=2)).splitlines()))
+        self.assertEqual(rows[0], ['id', 'colour_id', 'code'])
+        self.assertEqual([int(r[0]) for r in rows[1:]], pks)
+        self.assertEqual([r[2] for r in rows[1:]], ['p%d' % i for i in range(5)])
+
+    def test_json_lines_across_chunks(self):
+        pks = self.create_paints(4)
+        lines = list(export_json_lines(TestPaint, chunk_size=2))
+        self.assertEqual([json.loads(l)['id'] for l in lines], pks)
+        self.assertEqual(json.loads(lines[-1])['code'], 'p3')
+
+    def test_empty_table(self):
+        self.assertEqual(list(export_csv(TestPaint, chunk_size=2)), ['id,colour_id,code\r\n'])
+        self.assertEqual(list(export_json_lines(TestPaint)), [])
+
+    def test_workers(self):
+        if connection.settings_dict['NAME'] == ':memory:':
+            self.skipTest("Needs a test database file, shared between threads")
+        self.create_paints(3)
+        directory = tempfile.mkdtemp()
+        try:
+            paths = export_models([TestColour, TestPaint], directory, format='json', chunk_size=2, workers=2)
+            self.assertEqual([os.path.basename(p) for p in paths], ['dymo_testcolour.jsonl', 'dymo_testpaint.jsonl'])
+            self.assertEqual([len(open(p).readlines()) for p in paths], [1, 3])
+        finally:
+            shutil.rmtree(directory)
+
+
+class BatchSchemaChangesTest(TransactionTestCase):
+
+    def setUp(self):
+        if QUEUE_SCHEMA_CHANGES or DeletedTable is None:
+            self.skipTest("Needs DYMO_MANAGE_DELETIONS, without DYMO_QUEUE_SCHEMA_CHANGES")
+        cursor = connection.cursor()
+        for table_name in ('dymo_testbatched', 'dymo_testother'):
+            cursor.execute("CREATE TABLE %s (id integer PRIMARY KEY, a integer, b integer, c integer)" % table_name)
+        self.introspections = []
+        self._get_deleted_columns = signals.get_deleted_columns
+        self._table_names = connection.introspection.table_names
+        def get_deleted_columns(table_name, using):
+            self.introspections.append(table_name)
+            return self._get_deleted_columns(table_name, using)
+        def table_names():
+            self.introspections.append(None)
+            return self._table_names()
+        signals.get_deleted_columns = get_deleted_columns
+        connection.introspection.table_names = table_names
+
+    def tearDown(self):
+        signals.get_deleted_columns = self._get_deleted_columns
+        connection.introspection.table_names = self._table_names
+        cursor = connection.cursor()
+        for table_name in self._table_names():
+            if table_name in ('dymo_testbatched', 'dymo_testother') or table_name.startswith('_deleted_'):
+                cursor.execute("DROP TABLE %s" % table_name)
+
+    def get_columns(self, table_name):
+        return sorted(row[0] for row in connection.introspection.get_table_description(connection.cursor(), table_name))
+
+    def test_column_changes(self):
+        attributes = [TestAttribute.objects.create(table='dymo_testbatched', column=c) for c in 'abc']
+        with batch_schema_changes():
+            attributes[0].column = 'x'
+            attributes[0].save()
+            attributes[1].delete()
+            attributes[2].delete()
+        self.assertEqual(self.get_columns('dymo_testbatched'), ['_deleted_1', '_deleted_2', 'id', 'x'])
+        self.assertEqual(sorted(DeletedColumn.objects.values_list('original_name', 'current_name')),
+                         [('b', '_deleted_1'), ('c', '_deleted_2')])
+        self.assertEqual(self.introspections, ['dymo_testbatched'])
+
+    def test_bulk_delete(self):
+        for name, table_name in (('a', 'dymo_testbatched'), ('b', 'dymo_testother'), ('c', 'dymo_testmissing')):
+            TestDefinition.objects.create(name=name, table=table_name)
+        bulk_delete(TestDefinition.objects.all())
+        table_names = self._table_names()
+        self.assertTrue('dymo_testbatched' not in table_names and 'dymo_testother' not in table_names)
+        self.assertTrue('_deleted_1' in table_names and '_deleted_2' in table_names)
+        logs = dict(DeletedTable.objects.values_list('original_name', 'current_name'))
+        self.assertEqual(sorted(logs.keys()), ['dymo_testbatched', 'dymo_testmissing', 'dymo_testother'])
+        self.assertEqual(sorted(logs.values()), ['', '_deleted_1', '_deleted_2'])
+        self.assertEqual(self.introspections, [None])
+
+    def test_rolled_back_delete_is_not_applied(self):
+        definition = TestDefinition.objects.create(name='a', table='dymo_testbatched')
+        try:
+            with batch_schema_changes():
+                # As a delete that fails and is rolled back
+                with transaction.commit_manually():
+                    definition.delete()
+                    transaction.rollback()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(TestDefinition.objects.count(), 1)
+        self.assertTrue('dymo_testbatched' in self._table_names())
+        self.assertEqual(DeletedTable.objects.count(), 0)
+
+    def test_committed_changes_applied_when_block_raises(self):
+        definition = TestDefinition.objects.create(name='a', table='dymo_testbatched')
+        TestDefinition.objects.create(name='b', table='dymo_testother')
+        try:
+            with batch_schema_changes():
+                definition.delete()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertTrue('dymo_testbatched' not in self._table_names())
+        self.assertTrue('dymo_testother' in self._table_names())
+        self.assertEqual(list(DeletedTable.objects.values_list('original_name', flat=True)), ['dymo_testbatched'])
+
+
+class SchemaQueueTest(TestCase):
+
+    def setUp(self):
+        if SchemaJob is None:
+            self.skipTest("Needs DYMO_QUEUE_SCHEMA_CHANGES")
+        self.model = build_model('TestQueued', renamed=models.IntegerField(null=True))
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE dymo_testqueued (id integer PRIMARY KEY, original integer NULL)")
+
+    def tearDown(self):
+        connection.cursor().execute("DROP TABLE dymo_testqueued")
+        remove_from_model_cache('dymo', 'TestQueued')
+
+    def get_columns(self):
+        return [row[0] for row in connection.introspection.get_table_description(connection.cursor(), 'dymo_testqueued')]
+
+    def test_pending_rename_is_not_created(self):
+        enqueue(SchemaJob.RENAME_COLUMN, 'dymo_testqueued', 'original', 'renamed', 'dymo', 'TestQueued')
+        add_necessary_db_columns(self.model)
+        self.assertEqual(sorted(self.get_columns()), ['id', 'original'])
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(sorted(self.get_columns()), ['id', 'renamed'])
+
+    def test_failed_rename_holds_back_table(self):
+        failing = enqueue(SchemaJob.RENAME_COLUMN, 'dymo_testqueued', 'original', 'renamed', 'dymo', 'TestQueued')
+        held_back = enqueue(SchemaJob.DELETE_COLUMN, 'dymo_testqueued', 'renamed', app_label='dymo', object_name='TestQueued')
+        rename_db_column = db_module.rename_db_column
+        def fail(*args):
+            raise DatabaseError("Rename failed")
+        db_module.rename_db_column = fail
+        try:
+            self.assertEqual(run_pending_jobs(), 0)
+        finally:
+            db_module.rename_db_column = rename_db_column
+        self.assertEqual(get_job_status(failing.pk), SchemaJob.FAILED)
+        self.assertEqual(get_job_status(held_back.pk), SchemaJob.PENDING)
+        add_necessary_db_columns(self.model)
+        self.assertEqual(sorted(self.get_columns()), ['id', 'original'])
+
+        self.assertEqual(retry_failed_jobs('dymo_testqueued'), 1)
+        self.assertEqual(run_pending_jobs(), 2)
+        self.assertEqual(sorted(self.get_columns()), ['_deleted_1', 'id'])
+
+    def test_running_jobs_are_recovered(self):
+        job = enqueue(SchemaJob.RENAME_COLUMN, 'dymo_testqueued', 'original', 'renamed', 'dymo', 'TestQueued')
+        SchemaJob.objects.filter(pk=job.pk).update(status=SchemaJob.RUNNING)
+        self.assertEqual(recover_running_jobs(), 1)
+        self.assertEqual(run_pending_jobs(), 1)
+
+    def test_column_delete_job_has_app_label(self):
+        column_post_delete = build_column_post_delete('column', lambda i: 'TestQueued', lambda i: i.table)
+        column_post_delete(sender=TestAttribute, instance=TestAttribute(table='dymo_testqueued', column='original'))
+        job = get_pending_jobs().get()
+        self.assertEqual((job.app_label, job.object_name), ('dymo', 'TestQueued'))
+
+
+class IndexSyncTest(TransactionTestCase):
+
+    def tearDown(self):
+        connection.cursor().execute("DROP TABLE dymo_testindexed")
+        remove_from_model_cache('dymo', 'TestIndexed')
+
+    def test_index_replaced_by_unique(self):
+        model = build_model('TestIndexed', code=models.CharField(max_length=10, db_index=True))
+        create_db_table(model)
+        self.assertEqual(sync_db_indexes(model, concurrent_indexes=False), [])
+        remove_from_model_cache('dymo', 'TestIndexed')
+        model = build_model('TestIndexed', code=models.CharField(max_length=10, unique=True))
+        self.assertEqual(sync_db_indexes(model, concurrent_indexes=False),
+                         [(UNIQUE_CREATED, 'code'), (INDEX_DROPPED, 'code')])
+        index = _get_indexes(connection, 'dymo_testindexed')['code']
+        self.assertEqual((index['unique'], index['indexed']), (True, False))
+        self.assertEqual(sync_db_indexes(model, concurrent_indexes=False), [])
+
+    def test_unique_on_duplicates_is_reported(self):
+        model = build_model('TestIndexed', code=models.CharField(max_length=10, db_index=True))
+        create_db_table(model)
+        model.objects.create(code='a')
+        model.objects.create(code='a')
+        remove_from_model_cache('dymo', 'TestIndexed')
+        model = build_model('TestIndexed', code=models.CharField(max_length=10, unique=True))
+        self.assertEqual(sync_db_indexes(model, concurrent_indexes=False), [(UNIQUE_FAILED, 'code')])
+        self.assertFalse(transaction.is_managed())
+        index = _get_indexes(connection, 'dymo_testindexed')['code']
+        self.assertEqual((index['unique'], index['indexed']), (False, True))
+        self.assertEqual(model.objects.count(), 2)
+
+
+class PermissionsTest(TransactionTestCase):
+
+    def setUp(self):
+        meta = type('Meta', (object,), {'app_label': 'dymo', 'permissions': [('paint_testlicensed', 'Can paint')]})
+        self.model = type('TestLicensed', (models.Model,), {'__module__': 'dymo.tests', 'Meta': meta})
+        ContentType.objects.clear_cache()
+
+    def tearDown(self):
+        remove_from_model_cache('dymo', 'TestLicensed')
+        ContentType.objects.clear_cache()
+
+    def test_create_dynamic_permissions(self):
+        self.assertEqual(create_dynamic_permissions([self.model]), 4)
+        self.assertEqual(create_dynamic_permissions([self.model]), 0)
+        ctype = ContentType.objects.get_for_model(self.model)
+        codenames = Permission.objects.filter(content_type=ctype).values_list('codename', flat=True)
+        self.assertEqual(sorted(codenames), ['add_testlicensed', 'change_testlicensed', 
+                                             'delete_testlicensed', 'paint_testlicensed'])
+
+    def test_callers_transaction_is_not_committed(self):
+        with transaction.commit_manually():
+            self.assertEqual(create_dynamic_permissions([self.model]), 4)
+            transaction.rollback()
+        self.assertEqual(Permission.objects.filter(codename='add_testlicensed').count(), 0)
+
+
+class AdminDispatchTest(TestCase):
+
+    def setUp(self):
+        TestColour._definition_model = TestPaint
+        self.site = AdminSite(name='dymo_tests')
+        self.resolver = RegexURLResolver(r'^', admin_urls(self.site))
+        reregister_in_admin(self.site, TestColour, reload_urls=False)
+
+    def tearDown(self):
+        unregister_from_admin(self.site, TestColour, reload_urls=False)
+        del TestColour._definition_model
+
+    def test_resolve(self):
+        match = self.resolver.resolve('dymo/testcolour/')
+        self.assertEqual(match.url_name, 'dymo_testcolour_changelist')
+        self.assertRaises(Resolver404, self.resolver.resolve, 'dymo/testpaint/')
+        # Nothing is added for reverse()
+        self.assertEqual(len(self.resolver.reverse_dict), 0)
+
+    def test_unregister_by_table_name(self):
+        unregister_from_admin(self.site, old_table_name=TestColour._meta.db_table, reload_urls=False)
+        self.assertRaises(Resolver404, self.resolver.resolve, 'dymo/testcolour/')
+
+
+class PlacementTest(TestCase):
+
+    def test_hash_placement(self):
+        placement = HashPlacement(['shard1', 'shard2'], app_labels=['dymo'])
+        aliases = [placement('dymo', 'Model%d' % i) for i in range(100)]
+        self.assertEqual(set(aliases), set(['shard1', 'shard2']))
+        self.assertEqual(aliases, [placement('dymo', 'Model%d' % i) for i in range(100)])
+        self.assertEqual(placement('other', 'Model1'), None)
+
+    def test_chained_mapping_placement(self):
+        placement = ChainedPlacement(MappingPlacement({'dymo.Pinned': 'shard2', 'other': 'shard1'}),
+                                     HashPlacement(['default']))
+        self.assertEqual(placement('dymo', 'pinned'), 'shard2')
+        self.assertEqual(placement('other', 'Anything'), 'shard1')
+        self.assertEqual(placement('dymo', 'Anything'), 'default')
+
+
+class RoutingTest(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        set_placement(MappingPlacement({'dymo.TestSharded': 'shard1', 'dymo.Alpha': 'shard1'}))
+        self.router = DynamicModelRouter()
+        router.routers.insert(0, self.router)
+        self.model = build_model('TestSharded', name=models.CharField(max_length=10))
+
+    def tearDown(self):
+        router.routers.remove(self.router)
+        set_placement(None)
+        remove_from_model_cache('dymo', 'TestSharded')
+        for alias in ('default', 'shard1'):
+            if 'dymo_testsharded' in connections[alias].introspection.table_names():
+                connections[alias].cursor().execute("DROP TABLE dymo_testsharded")
+
+    def test_router(self):
+        self.assertEqual(self.router.db_for_read(self.model), 'shard1')
+        self.assertEqual(self.router.db_for_write(self.model), 'shard1')
+        self.assertEqual(self.router.db_for_write(TestColour), None)
+        self.assertFalse(self.router.allow_relation(self.model(), TestColour()))
+        self.assertTrue(self.router.allow_syncdb('shard1', self.model))
+        self.assertFalse(self.router.allow_syncdb('default', self.model))
+
+    def test_table_created_on_alias(self):
+        create_db_table(self.model)
+        self.assertTrue('dymo_testsharded' in connections['shard1'].introspection.table_names())
+        self.assertFalse('dymo_testsharded' in connections['default'].introspection.table_names())
+
+        self.model.objects.create(name="one")
+        self.assertEqual(self.model.objects.db, 'shard1')
+        self.assertEqual(self.model.objects.count(), 1)
+
+    def test_rename_across_databases_is_refused(self):
+        definition = TestDefinition.objects.create(name='Alpha', table='dymo_alpha')
+        definition.name = 'Beta'
+        self.assertRaises(ValueError, definition.save)
+
+        # A rename on the same database goes ahead there
+        shard = connections['shard1']
+        shard.cursor().execute("CREATE TABLE dymo_alpha (id integer PRIMARY KEY)")
+        definition.name = 'Alpha'
+        definition.table = 'dymo_alpha2'
+        definition.save()
+        if SchemaJob is not None:
+            run_pending_jobs()
+        self.assertTrue('dymo_alpha2' in shard.introspection.table_names())
+        shard.cursor().execute("DROP TABLE dymo_alpha2")
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import re
+import hashlib
 from django.utils.translation import ugettext as _
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, connection
 
 """ Validation functions
 
@@ -21,41 +23,90 @@ RESERVED_ATTRIBUTES = (
     + ['MultipleObjectsReturned', 'DoesNotExist'] # Added by base
     + ['_order', 'id', '_meta', 'pk'] # Added by options
     )
+_RESERVED_ATTRIBUTE_SET = frozenset(RESERVED_ATTRIBUTES)
 
 # This is prefixed to model field names when a reserved system name is used.
 CONFLICT_STRING = '_noconflict_'
 
-def validate_identifier_slug(val):
-    """ Validates a slug that will be used to generate an identifier. """
-    # TODO: Extend standard slug validation?
+# Precompiled patterns, these functions are run over every field definition
+# when large schemas are imported.
+IDENTIFIER_SLUG_RE = re.compile(r'^[A-Za-z0-9-]*\Z')
+NON_ALNUM_RE = re.compile(r'[^A-Za-z0-9]+')
+NON_IDENTIFIER_RE = re.compile(r'[^a-z0-9_]+')
+MULTIPLE_UNDERSCORE_RE = re.compile(r'__+')
+CONFLICT_PREFIXES = (CONFLICT_STRING, CONFLICT_STRING.replace("_","-"))
+
+# Length of the hashed suffix given to shortened identifiers.
+# This is the same as Django's truncate_name(), so that shortened M2M table
+# names match the ones Django generates when there is no collision.
+HASH_LENGTH = 4
+
+
+def _identifier_slug_error(val):
+    """ Returns the first validation message for the given slug, or None. """
     # Ensure this can be encoded in ASCII without change
     try:
         val.encode("ascii")
     except UnicodeEncodeError:
-        raise ValidationError(_("Please use standard letters and numbers, no accents."))
+        return _("Please use standard letters and numbers, no accents.")
 
     # Ensure the string only has valid characters
-    for char in val:
-        if not char.isalnum() and char not in "-":
-            raise ValidationError(_("A key may only contain letters, numbers and hyphen (-)."))
+    if not IDENTIFIER_SLUG_RE.match(val):
+        return _("A key may only contain letters, numbers and hyphen (-).")
 
     # Identifiers generally must start with a character, not a digit
     if val[:1].isdigit():
-        raise ValidationError(_("A key must start with a letter, not a number."))
+        return _("A key must start with a letter, not a number.")
 
     # Ensure that the slug does not begin with conflict string
-    if val.startswith(CONFLICT_STRING) or val.startswith(CONFLICT_STRING.replace("_","-")):
-        raise ValidationError(_("A key cannot start with %s.") % CONFLICT_STRING)
+    if val.startswith(CONFLICT_PREFIXES):
+        return _("A key cannot start with %s.") % CONFLICT_STRING
+
+
+def validate_identifier_slug(val):
+    """ Validates a slug that will be used to generate an identifier. """
+    # TODO: Extend standard slug validation?
+    error = _identifier_slug_error(val)
+    if error is not None:
+        raise ValidationError(error)
 
     return val
 
 
+def validate_identifier_slugs(values, normalise=None):
+    """ Validates many slugs in one pass, returning a dictionary of 
+        {slug: [messages]} for every invalid slug (empty if all are valid).
+        Slugs that would produce the same identifier are also reported,
+        normalise is the conversion used (default: slug_to_identifier).
+    """
+    if normalise is None:
+        normalise = slug_to_identifier
+
+    errors = {}
+    seen = {}
+    for val in values:
+        error = _identifier_slug_error(val)
+        if error is not None:
+            errors.setdefault(val, []).append(error)
+            continue
+
+        identifier = normalise(val)
+        if identifier in seen:
+            message = _("%(a)s and %(b)s both become %(identifier)s.") % {
+                        'a': seen[identifier], 'b': val, 'identifier': identifier}
+            errors.setdefault(val, []).append(message)
+        else:
+            seen[identifier] = val
+
+    return errors
+
+
 def slug_to_class_name(val):
     """ Prepare the given value to be used as a python class name. 
         Non-ascii characters and leading digits are stripped.
     """
     val = val.encode('ascii', 'ignore').title()
-    return filter(lambda s: s.isalnum(), val).lstrip("0123456789")
+    return NON_ALNUM_RE.sub('', val).lstrip("0123456789")
 
 
 def slug_to_identifier(val):
@@ -64,24 +115,88 @@ def slug_to_identifier(val):
     val = val.encode('ascii', 'ignore').replace("-","_").lower()
 
     # filter our undesired characters
-    val = filter(lambda x: x.isalnum() or x in "_", val)
+    val = NON_IDENTIFIER_RE.sub('', val)
 
     # Model fields cannot contain double underscore. It's best to remove them early
     # to ensure uniqueness constraints are caught when the user can change them
-    while "__" in val:
-        val = val.replace("__", "_")
+    val = MULTIPLE_UNDERSCORE_RE.sub('_', val)
 
     # Remove leading digits and underscores
     return val.lstrip("0123456789_")
 
 
+def slugs_to_identifiers(values):
+    """ Converts many slugs at once, see slug_to_identifier. """
+    return [slug_to_identifier(val) for val in values]
+
+
 def slug_to_model_field_name(val):
     """ Prepare the given value to be used as a model attribute identifier. """
     val = slug_to_identifier(val)
 
     # Ensure we don't end up with something that will conflict with model attributes
-    if val in RESERVED_ATTRIBUTES:
+    if val in _RESERVED_ATTRIBUTE_SET:
         val = CONFLICT_STRING + val
 
     return val
 
+
+def shorten_identifier(name, max_length=None, existing=None, hash_length=HASH_LENGTH):
+    """ Shortens a table or column name to fit the database's name length limit.
+        Long names are cut and given a deterministic hashed suffix.
+
+        existing is an optional index of {shortened name: original name},
+        see build_identifier_index. If the shortened name is already taken 
+        by a different original name, the hash is salted until it is free.
+        The chosen name is added to the index.
+    """
+    if max_length is None:
+        max_length = connection.ops.max_name_length()
+
+    short_name = name
+    salt = 0
+    while True:
+        if max_length and len(short_name) > max_length or salt:
+            short_name = _hashed_name(name, max_length or len(name), hash_length, salt)
+        owner = existing.get(short_name, name) if existing is not None else name
+        if owner == name:
+            break
+        salt += 1
+
+    if existing is not None:
+        existing[short_name] = name
+    return short_name
+
+
+def shorten_m2m_table_name(table_name, field_name, max_length=None, existing=None):
+    """ Returns the (shortened) table name for an implied M2M table. """
+    return shorten_identifier('%s_%s' % (table_name, field_name), max_length, existing)
+
+
+def build_identifier_index(names, max_length=None):
+    """ Builds an in-memory index of the shortened forms of the given names,
+        which can be passed to shorten_identifier as existing, so that
+        collisions are found without querying the database for each name.
+        Names are processed in order, so the result is deterministic.
+
+        Give the original (long) names, eg. those of the existing dynamic 
+        model definitions, in the order they were created. Introspected 
+        names are already shortened, so a new name whose shortened form 
+        equals one of them couldn't be told apart from its owner.
+    """
+    index = {}
+    for name in names:
+        shorten_identifier(name, max_length, index)
+    return index
+
+
+def _hashed_name(name, max_length, hash_length, salt):
+    """ Cuts the name to max_length, replacing the end with a hash of the 
+        full name. A salt > 0 gives an alternative hash for collisions.
+    """
+    if salt:
+        value = '%s:%d' % (name, salt)
+    else:
+        value = name
+    digest = hashlib.md5(value.encode('utf-8')).hexdigest()[:hash_length]
+    return name[:max_length - hash_length] + digest
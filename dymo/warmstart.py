@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Warm-start: build dynamic model classes from a file instead of the database.
+
+    save_warm_start() writes a versioned description of every registered
+    dynamic model (fields, Meta options and hash), using South's
+    introspection. When DYMO_WARM_START_FILE is set, register_dynamic_models
+    builds the classes from this file on startup, without querying the
+    definition tables. Models whose hash no longer matches the shared hash
+    in the cache are ignored, and all models of that registry are then
+    built the normal way.
+
+    Only the fields and Meta options are restored. Dynamic model classes
+    with extra methods or attributes can be given them with an attrs_fn,
+    which takes a description and returns a dictionary.
+"""
+
+import os
+import logging
+import datetime
+import decimal
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.importlib import import_module
+
+from .sync import HASH_CACHE_TEMPLATE
+
+logger = logging.getLogger('dymo')
+
+WARM_START_FILE = getattr(settings, "DYMO_WARM_START_FILE", None)
+
+# Increment this when the description format changes
+FORMAT_VERSION = 1
+
+
+def describe_model(model, local_hash=lambda i: i._hash):
+    """ Returns a compact description of the given dynamic model. 
+        Raises ValueError if South can't introspect any of its fields.
+    """
+    from south.modelsinspector import get_model_fields, get_model_meta
+    fields = get_model_fields(model, m2m=True)
+    unknown = [name for name, triple in fields.items() if triple is None]
+    if unknown:
+        raise ValueError("Cannot describe %s.%s, South can't introspect these fields "
+                    "(add introspection rules or south_field_triple()): %s" 
+                    % (model._meta.app_label, model._meta.object_name, ", ".join(unknown)))
+    return {
+        'app_label': model._meta.app_label,
+        'object_name': model._meta.object_name,
+        'module': model.__module__,
+        'hash': local_hash(model),
+        'fields': [(name,) + tuple(triple) for name, triple in fields.items()],
+        'meta': get_model_meta(model),
+    }
+
+
+def save_warm_start(path=None, local_hash=lambda i: i._hash):
+    """ Writes descriptions of all registered dynamic models to the given file.
+        The file is replaced atomically, so running processes never read
+        a partial file. Registries with a model that can't be described are
+        left out, and are built the normal way.
+    """
+    from .registry import _dynamic_model_registry, get_dynamic_models
+    path = path or WARM_START_FILE
+
+    registries = {}
+    for name in _dynamic_model_registry:
+        try:
+            registries[name] = [describe_model(m, local_hash) for m in get_dynamic_models(name)]
+        except ValueError, e:
+            logger.warning("Leaving '%s' out of the warm-start file: %s" % (name, e))
+
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    f = open(tmp_path, 'wb')
+    try:
+        pickle.dump({'version': FORMAT_VERSION, 'registries': registries}, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+    logger.debug("Saved %d dynamic model registries to '%s'" % (len(registries), path))
+
+
+def load_warm_start(path=None):
+    """ Returns {registry name: [descriptions]} from the given file, or None if
+        the file is missing, unreadable or from another version.
+    """
+    path = path or WARM_START_FILE
+    try:
+        f = open(path, 'rb')
+        try:
+            data = pickle.load(f)
+        finally:
+            f.close()
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+    if data.get('version') != FORMAT_VERSION:
+        return None
+    return data['registries']
+
+
+def is_current(description):
+    """ Checks the description against the shared hash generation. """
+    CACHE_KEY = HASH_CACHE_TEMPLATE % (description['app_label'], description['object_name'])
+    return cache.get(CACHE_KEY) == description['hash']
+
+
+def build_model(description, attrs_fn=None):
+    """ Builds a model class from the given description. """
+    attrs = {
+        '__module__': description['module'],
+        '_hash': description['hash'],
+    }
+    for name, class_path, args, kwargs in description['fields']:
+        module_name, class_name = class_path.rsplit(".", 1)
+        field_class = getattr(import_module(module_name), class_name)
+        attrs[name] = field_class(*[_evaluate(a) for a in args],
+                        **dict((k, _evaluate(v)) for k, v in kwargs.items()))
+
+    meta = dict((k, _evaluate(v)) for k, v in description['meta'].items() if k != 'object_name')
+    meta['app_label'] = description['app_label']
+    attrs['Meta'] = type('Meta', (), meta)
+
+    if attrs_fn is not None:
+        attrs.update(attrs_fn(description))
+
+    return type(str(description['object_name']), (models.Model,), attrs)
+
+
+def warm_start(name, path=None, attrs_fn=None):
+    """ Builds the models of the given registry from the warm-start file.
+        Returns the built models, or None if the file is missing or any
+        model is out of date, in which case nothing is built.
+    """
+    registries = load_warm_start(path)
+    if registries is None or name not in registries:
+        return None
+
+    descriptions = registries[name]
+    if not all(is_current(d) for d in descriptions):
+        logger.debug("Warm-start file is out of date for '%s'" % name)
+        return None
+
+    return [build_model(d, attrs_fn) for d in descriptions]
+
+
+class _LazyORM(object):
+    """ Stands in for South's frozen ORM, returning lazy "app.Model" references
+        which Django resolves once the related model is available.
+    """
+    def __getitem__(self, key):
+        return key
+
+
+_EVAL_CONTEXT = {
+    'models': models,
+    'datetime': datetime,
+    'decimal': decimal,
+    'orm': _LazyORM(),
+}
+
+def _evaluate(value):
+    " Evaluates a value as frozen by South's introspector. "
+    return eval(value, dict(_EVAL_CONTEXT))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Runs the dymo tests on SQLite databases.
+
+        python runtests.py [--queue] [test labels]
+
+    The default database is joined by two others (shard1 and shard2) for
+    the tests of dymo.routing. With --queue, schema changes are queued 
+    (DYMO_QUEUE_SCHEMA_CHANGES), for the tests of dymo.jobs.
+
+    The default test database is a temporary file rather than in memory,
+    so that the threads of dymo.export.export_models can share it.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from django.conf import settings
+
+
+def sqlite_database(name=':memory:'):
+    return {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name, 'TEST_NAME': name}
+
+
+def main():
+    parser = OptionParser(usage="%prog [--queue] [test labels]")
+    parser.add_option('--queue', action='store_true', default=False,
+                      help="Queue schema changes, see dymo.jobs")
+    options, labels = parser.parse_args()
+    directory = tempfile.mkdtemp()
+
+    settings.configure(
+        DATABASES = {
+            'default': sqlite_database(os.path.join(directory, 'dymo_tests.db')),
+            'shard1': sqlite_database(),
+            'shard2': sqlite_database(),
+        },
+        INSTALLED_APPS = (
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django.contrib.admin',
+            'south',
+            'dymo',
+        ),
+        ROOT_URLCONF = 'dymo.test_urls',
+        SOUTH_TESTS_MIGRATE = False,
+        DYMO_MANAGE_DELETIONS = True,
+        DYMO_QUEUE_SCHEMA_CHANGES = options.queue,
+    )
+
+    from django.test.utils import get_runner
+    TestRunner = get_runner(settings)
+    try:
+        failures = TestRunner(verbosity=1, interactive=False).run_tests(labels or ['dymo'])
+    finally:
+        shutil.rmtree(directory)
+    sys.exit(bool(failures))
+
+
+if __name__ == '__main__':
+    main()
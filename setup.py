@@ -12,7 +12,7 @@ from setuptools import setup, find_packages
 setup(
     name = "Django-DyMo",
     version = '0.1',
-    packages = find_packages(),
+    packages = find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires = ['django>=1.3'],
     author = "Will Hardy",
     author_email = "django-dymo@willhardy.com.au",